@@ -0,0 +1,599 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import argparse, fnmatch, json, os, random, resource, subprocess, sys, threading, time
+import datetime
+import botocore.exceptions
+from dateutil.tz import tzutc
+
+# benchmark.py
+#
+#    Measures how photographer.py and reserved_instance_report.py scale against synthetic accounts served by an
+#    in-memory stand-in for EC2, S3 and SES. Each scenario runs in its own process and records:
+#       wall time of the lambda_handler call
+#       API calls made, per operation
+#       peak resident memory of the process (and the memory in use before the handler ran)
+#       peak number of threads
+#
+#    Results are written as JSON, named after the current commit, so runs of different commits can be compared:
+#       python benchmarks/benchmark.py                       run every scenario
+#       python benchmarks/benchmark.py photographer-small    run the named scenarios
+#       python benchmarks/benchmark.py --compare old.json new.json
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+scripts_dir = os.path.join(os.path.dirname(benchmark_dir), 'scripts')
+results_dir = os.path.join(benchmark_dir, 'results')
+
+# Scenarios
+#
+# Photographer scenarios describe the account: policies, the volumes and instances they cover (spread over the
+# regions), the days of daily backup history each asset already has and the latency of every API call in seconds.
+# settings overrides module level settings of the script, e.g. to lift the deletion rate limit. With events the
+# handler is given a batch of that many events instead of scanning, see build_events, and runs invokes it that many
+# times in succession (copies to a dr_region complete at once, so a second run confirms them and applies retention).
+# Regions beyond those with resources are enabled by listing every region in enabled_regions.
+# RI report scenarios give the number of reservations and running instances in each region and a latency per region.
+# Scenarios with import_only measure a script's cold start instead, see measure_import.
+scenarios = {
+    'photographer-small': {'script': 'photographer', 'policies': 2, 'volumes': 10, 'instances': 4, 'history': 30,
+                           'regions': ['eu-west-1'], 'latency': 0.01,
+                           'settings': {'deletion_rate': 1000, 'deletion_burst': 1000}},
+    'photographer-medium': {'script': 'photographer', 'policies': 10, 'volumes': 100, 'instances': 40, 'history': 45,
+                            'regions': ['eu-west-1', 'us-east-1'], 'latency': 0.02,
+                            'settings': {'deletion_rate': 1000, 'deletion_burst': 1000}},
+    'photographer-large': {'script': 'photographer', 'policies': 20, 'volumes': 400, 'instances': 100, 'history': 60,
+                           'regions': ['eu-west-1', 'us-east-1', 'ap-southeast-2'], 'latency': 0.005,
+                           'settings': {'deletion_rate': 1000, 'deletion_burst': 1000}},
+    'photographer-dr': {'script': 'photographer', 'policies': 2, 'volumes': 10, 'instances': 4, 'history': 30,
+                        'regions': ['eu-west-1'], 'enabled_regions': ['eu-west-1', 'us-west-2'], 'latency': 0.01, 'runs': 2,
+                        'settings': {'deletion_rate': 1000, 'deletion_burst': 1000, 'copy_rate': 1000, 'copy_burst': 1000,
+                                     'dr_region': 'us-west-2'}},
+    'photographer-events': {'script': 'photographer', 'policies': 10, 'volumes': 100, 'instances': 40, 'history': 45,
+                            'regions': ['eu-west-1', 'us-east-1'], 'latency': 0.02, 'events': 10,
+                            'settings': {'deletion_rate': 1000, 'deletion_burst': 1000}},
+    'photographer-import': {'script': 'photographer', 'import_only': True},
+    'ri-report-import': {'script': 'reserved_instance_report', 'import_only': True},
+    'ri-report': {'script': 'reserved_instance_report', 'reservations': 200, 'instances': 2000,
+                  'latency': {'us-east-1': 0.1, 'us-west-2': 0.15, 'us-west-1': 0.15, 'eu-west-1': 0.02,
+                              'eu-central-1': 0.03, 'ap-southeast-1': 0.3, 'ap-southeast-2': 0.3,
+                              'ap-northeast-1': 0.25, 'sa-east-1': 0.2}},
+    'ri-report-large': {'script': 'reserved_instance_report', 'reservations': 3000, 'instances': 20000,
+                        'latency': {'us-east-1': 0.1, 'us-west-2': 0.15, 'us-west-1': 0.15, 'eu-west-1': 0.02,
+                                    'eu-central-1': 0.03, 'ap-southeast-1': 0.3, 'ap-southeast-2': 0.3,
+                                    'ap-northeast-1': 0.25, 'sa-east-1': 0.2}},
+}
+
+
+
+# Body
+#
+# Stand-in for the streaming body of an S3 get_object response.
+class Body(object):
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, size=None):
+        if size is None or size < 0:
+            size = len(self.data) - self.position
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+
+
+# Paginator
+#
+# Stand-in for a botocore paginator, serving a describe call's results in pages.
+class Paginator(object):
+    page_size = 1000
+
+    def __init__(self, client, operation, result_key):
+        self.client = client
+        self.operation = operation
+        self.result_key = result_key
+
+    def paginate(self, **kwargs):
+        items = getattr(self.client, self.operation)(**kwargs)[self.result_key]
+        for start in range(0, max(len(items), 1), self.page_size):
+            if start:
+                self.client.backend.record(self.client.region, self.operation)
+            yield {self.result_key: items[start:start + self.page_size]}
+
+
+
+# FakeClient
+#
+# Answers the EC2, S3 and SES calls the scripts make from a FakeBackend, recording each call and sleeping for the
+# scenario's latency first.
+class FakeClient(object):
+    paginated = {'describe_instances': u'Reservations', 'describe_volumes': u'Volumes',
+                 'describe_snapshots': u'Snapshots', 'list_objects_v2': u'Contents'}
+
+    def __init__(self, backend, service, region):
+        self.backend = backend
+        self.service = service
+        self.region = region
+
+    def call(self, operation):
+        self.backend.record(self.region, operation)
+
+    def can_paginate(self, operation):
+        return operation in self.paginated
+
+    def get_paginator(self, operation):
+        return Paginator(self, operation, self.paginated[operation])
+
+    def describe_instances(self, Filters=None, **kwargs):
+        self.call('describe_instances')
+        return {u'Reservations': [{u'Instances': [instance]} for instance in self.backend.match(self.region, 'instances', Filters)]}
+
+    def describe_volumes(self, Filters=None, **kwargs):
+        self.call('describe_volumes')
+        return {u'Volumes': self.backend.match(self.region, 'volumes', Filters)}
+
+    def describe_snapshots(self, Filters=None, **kwargs):
+        self.call('describe_snapshots')
+        return {u'Snapshots': self.backend.match(self.region, 'snapshots', Filters)}
+
+    def describe_images(self, Filters=None, **kwargs):
+        self.call('describe_images')
+        return {u'Images': self.backend.match(self.region, 'images', Filters)}
+
+    def describe_regions(self, **kwargs):
+        self.call('describe_regions')
+        regions = self.backend.scenario.get('enabled_regions') or self.backend.scenario.get('latency')
+        if not isinstance(regions, (dict, list)):
+            regions = self.backend.regions
+        return {u'Regions': [{u'RegionName': region} for region in sorted(regions)]}
+
+    def describe_reserved_instances(self, **kwargs):
+        self.call('describe_reserved_instances')
+        return {u'ReservedInstances': list(self.backend.region(self.region)['reserved_instances'])}
+
+    # The tags of a TagSpecifications argument, rejected as EC2 does if any are reserved for AWS or there are too many.
+    def specified_tags(self, operation, kwargs):
+        tags = [tag for spec in kwargs.get('TagSpecifications', []) for tag in spec['Tags']]
+        if len(tags) > 50 or any(tag['Key'].startswith('aws:') for tag in tags):
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidParameterValue', 'Message': 'Invalid tags'}}, operation)
+        return tags
+
+    def create_snapshot(self, VolumeId=None, Description=None, DryRun=False, **kwargs):
+        self.call('create_snapshot')
+        tags = self.specified_tags('CreateSnapshot', kwargs)
+        snapshot = self.backend.add_snapshot(self.region, VolumeId, Description, datetime.datetime.now(tzutc()), u'pending')
+        self.backend.tag(self.region, [snapshot[u'SnapshotId']], tags)
+        return dict(snapshot, ResponseMetadata={})
+
+    def create_image(self, InstanceId=None, Name=None, Description=None, DryRun=False, **kwargs):
+        self.call('create_image')
+        tags = self.specified_tags('CreateImage', kwargs)
+        image = self.backend.add_image(self.region, InstanceId, Name, datetime.datetime.now(tzutc()), u'pending', tagged=False)
+        self.backend.tag(self.region, [image[u'ImageId']], tags)
+        return {u'ImageId': image[u'ImageId'], 'ResponseMetadata': {}}
+
+    def copy_snapshot(self, SourceRegion=None, SourceSnapshotId=None, Description=None, DryRun=False, **kwargs):
+        self.call('copy_snapshot')
+        tags = self.specified_tags('CopySnapshot', kwargs)
+        snapshot = self.backend.add_snapshot(self.region, 'vol-ffffffff', Description, datetime.datetime.now(tzutc()))
+        self.backend.tag(self.region, [snapshot[u'SnapshotId']], tags)
+        return {u'SnapshotId': snapshot[u'SnapshotId'], 'ResponseMetadata': {}}
+
+    def copy_image(self, SourceRegion=None, SourceImageId=None, Name=None, Description=None, DryRun=False, **kwargs):
+        self.call('copy_image')
+        image = self.backend.add_image(self.region, SourceImageId, Name, datetime.datetime.now(tzutc()), tagged=False)
+        return {u'ImageId': image[u'ImageId'], 'ResponseMetadata': {}}
+
+    def create_tags(self, Resources=None, Tags=None, DryRun=False, **kwargs):
+        self.call('create_tags')
+        self.backend.tag(self.region, Resources, Tags)
+        return {}
+
+    def deregister_image(self, ImageId=None, DryRun=False, **kwargs):
+        self.call('deregister_image')
+        self.backend.remove(self.region, 'images', ImageId)
+        return {}
+
+    def delete_snapshot(self, SnapshotId=None, DryRun=False, **kwargs):
+        self.call('delete_snapshot')
+        self.backend.remove(self.region, 'snapshots', SnapshotId)
+        return {}
+
+    def get_object(self, Bucket=None, Key=None, **kwargs):
+        self.call('get_object')
+        if Key not in self.backend.objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+        etag = '"%s"' % hash(self.backend.objects[Key])
+        if kwargs.get('IfNoneMatch') == etag:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        return {u'Body': Body(self.backend.objects[Key]), u'ETag': etag}
+
+    def put_object(self, Bucket=None, Key=None, Body=None, **kwargs):
+        self.call('put_object')
+        self.backend.objects[Key] = Body
+        return {}
+
+    def list_objects_v2(self, Bucket=None, Prefix='', **kwargs):
+        self.call('list_objects_v2')
+        return {u'Contents': [{u'Key': key} for key in sorted(self.backend.objects) if key.startswith(Prefix)]}
+
+    def get_bucket_location(self, Bucket=None, **kwargs):
+        self.call('get_bucket_location')
+        return {u'LocationConstraint': 'eu-west-1'}
+
+    def send_email(self, **kwargs):
+        self.call('send_email')
+        self.backend.sent.append(kwargs)
+        return {u'MessageId': 'benchmark'}
+
+    def send_raw_email(self, **kwargs):
+        self.call('send_raw_email')
+        self.backend.sent.append(kwargs)
+        return {u'MessageId': 'benchmark'}
+
+
+
+# FakeBackend
+#
+# The synthetic account: resources per region, S3 objects and sent emails, along with the API call counts.
+class FakeBackend(object):
+    def __init__(self, scenario, seed=42):
+        self.scenario = scenario
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.calls = {}
+        self.regions = {}
+        self.objects = {}
+        self.sent = []
+        self.counter = 0
+
+    def latency(self, region):
+        latency = self.scenario.get('latency', 0)
+        if isinstance(latency, dict):
+            latency = latency.get(region, 0)
+        return latency
+
+    def record(self, region, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        time.sleep(self.latency(region))
+
+    def get_client(self, service, aws_region=None, *args, **kwargs):
+        return FakeClient(self, service, aws_region)
+
+    def region(self, region):
+        with self.lock:
+            return self.regions.setdefault(region, {'instances': {}, 'volumes': {}, 'snapshots': {}, 'images': {}, 'reserved_instances': []})
+
+    def next_id(self, prefix):
+        with self.lock:
+            self.counter += 1
+            return '%s-%08x' % (prefix, self.counter)
+
+    def match(self, region, kind, filters):
+        items = list(self.region(region)[kind].values())
+        for f in filters or []:
+            items = [item for item in items if any(fnmatch.fnmatchcase(value, pattern) for value in self.values(item, f['Name']) for pattern in f['Values'])]
+        return items
+
+    def values(self, item, name):
+        tags = item.get(u'Tags', [])
+        if name == 'tag-key':
+            return [tag[u'Key'] for tag in tags]
+        if name.startswith('tag:'):
+            return [tag[u'Value'] for tag in tags if tag[u'Key'] == name[4:]]
+        fields = {'description': u'Description', 'volume-id': u'VolumeId', 'snapshot-id': u'SnapshotId',
+                  'image-id': u'ImageId', 'instance-id': u'InstanceId'}
+        if name in fields:
+            return [item.get(fields[name], '')]
+        if name == 'instance-state-name':
+            return [item[u'State'][u'Name']]
+        raise ValueError('Filter %s is not supported by the benchmark backend' % name)
+
+    def add_snapshot(self, region, volume_id, description, start_time, state=u'completed', tags=None):
+        snapshot = {u'SnapshotId': self.next_id('snap'), u'VolumeId': volume_id, u'Description': description,
+                    u'StartTime': start_time, u'State': state, u'Tags': tags or []}
+        self.region(region)['snapshots'][snapshot[u'SnapshotId']] = snapshot
+        return snapshot
+
+    def add_image(self, region, instance_id, name, creation_date, state=u'available', tagged=True):
+        snapshot = self.add_snapshot(region, 'vol-ffffffff', 'Created by CreateImage(%s) for ami' % instance_id, creation_date)
+        image = {u'ImageId': self.next_id('ami'), u'Name': name, u'State': state,
+                 u'CreationDate': creation_date.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                 u'Tags': [{u'Key': u'source_instance', u'Value': instance_id}] if tagged else [],
+                 u'BlockDeviceMappings': [{u'DeviceName': '/dev/xvda', u'Ebs': {u'SnapshotId': snapshot[u'SnapshotId']}}]}
+        self.region(region)['images'][image[u'ImageId']] = image
+        return image
+
+    def tag(self, region, resources, tags):
+        data = self.region(region)
+        with self.lock:
+            for resource_id in resources:
+                for kind in ('images', 'snapshots', 'volumes', 'instances'):
+                    if resource_id in data[kind]:
+                        data[kind][resource_id][u'Tags'] = list(tags)
+
+    def remove(self, region, kind, resource_id):
+        with self.lock:
+            if self.region(region)[kind].pop(resource_id, None) is None:
+                raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidID.NotFound', 'Message': resource_id}}, 'Delete')
+
+
+
+# build_photographer_account
+#
+# Populate the backend with the volumes, instances and backup history of a photographer scenario and return the
+# photographer.conf covering them. Backups were taken daily at around midnight, with a few minutes of jitter.
+def build_photographer_account(backend, scenario):
+    now = datetime.datetime.now(tzutc())
+    sections = []
+    for policy in range(scenario['policies']):
+        region = scenario['regions'][policy % len(scenario['regions'])]
+        volume_ids, instance_ids, instance_names = [], [], []
+
+        for volume in range(policy, scenario['volumes'], scenario['policies']):
+            volume_id = backend.next_id('vol')
+            backend.region(region)['volumes'][volume_id] = {u'VolumeId': volume_id, u'Attachments': [],
+                                                            u'Tags': [{u'Key': u'Name', u'Value': 'volume-%s' % volume}]}
+            for day in range(scenario['history']):
+                start_time = now - datetime.timedelta(days=day + 1, minutes=backend.random.randint(0, 30))
+                backend.add_snapshot(region, volume_id, 'Created by Photographer(%s) - Not Attached' % volume_id, start_time)
+            volume_ids.append(volume_id)
+
+        for instance in range(policy, scenario['instances'], scenario['policies']):
+            instance_id = backend.next_id('i')
+            name = 'instance-%s' % instance
+            backend.region(region)['instances'][instance_id] = {u'InstanceId': instance_id, u'State': {u'Name': u'running'},
+                                                                u'Tags': [{u'Key': u'Name', u'Value': name}]}
+            for day in range(scenario['history']):
+                creation_date = now - datetime.timedelta(days=day + 1, minutes=backend.random.randint(0, 30))
+                backend.add_image(region, instance_id, '%s %s - Taken by Photographer' % (instance_id, creation_date.isoformat()), creation_date)
+            if instance % 2:
+                instance_names.append(name)
+            else:
+                instance_ids.append(instance_id)
+
+        sections.append('[policy-%s]\naws_region: %s\nmost_recent: 5\ndays: 7\nweeks: 4\nmonths: 6\n'
+                        'volume_ids: %s\ninstance_ids: %s\ninstance_names: %s\n'
+                        % (policy, region, ' '.join(volume_ids) or 'None', ' '.join(instance_ids) or 'None',
+                           ' '.join(instance_names) or 'None'))
+    return '\n'.join(sections)
+
+
+
+# build_events
+#
+# The SQS batch of EventBridge events given to photographer by a scenario with events: that many EBS Snapshot
+# Notifications, each for a snapshot just completed (and added to the account) of a different volume, and as many
+# Photographer Backup events for instances.
+def build_events(backend, scenario):
+    now = datetime.datetime.now(tzutc())
+    volumes = sorted((volume_id, region) for region in backend.regions for volume_id in backend.regions[region]['volumes'])
+    instances = sorted((instance_id, region) for region in backend.regions for instance_id in backend.regions[region]['instances'])
+    events = []
+    for volume_id, region in volumes[:scenario['events']]:
+        snapshot = backend.add_snapshot(region, volume_id, 'Created by Photographer(%s) - Not Attached' % volume_id, now)
+        events.append({'detail-type': 'EBS Snapshot Notification', 'source': 'aws.ec2', 'account': '123456789012', 'region': region,
+                       'id': snapshot[u'SnapshotId'], 'resources': ['arn:aws:ec2::%s:snapshot/%s' % (region, snapshot[u'SnapshotId'])],
+                       'detail': {'event': 'createSnapshot', 'result': 'succeeded',
+                                  'snapshot_id': 'arn:aws:ec2::%s:snapshot/%s' % (region, snapshot[u'SnapshotId']),
+                                  'source': 'arn:aws:ec2::%s:volume/%s' % (region, volume_id)}})
+    for instance_id, region in instances[:scenario['events']]:
+        events.append({'detail-type': 'Photographer Backup', 'source': 'photographer', 'account': '123456789012', 'region': region,
+                       'id': instance_id, 'detail': {'asset_id': instance_id, 'aws_region': region}})
+    return {'Records': [{'body': json.dumps(event)} for event in events]}
+
+
+
+# build_reservations
+#
+# Populate every region of an RI report scenario with reservations ending at random over the next 18 months (and a
+# few recently expired), zonal or regional, and with running instances of the same types spread over two AZs.
+def build_reservations(backend, scenario):
+    now = datetime.datetime.now(tzutc())
+    instance_types = ['t2.micro', 'm4.large', 'c4.xlarge', 'r3.2xlarge']
+    platforms = ['Linux/UNIX', 'Windows']
+    for region in scenario['latency']:
+        for reservation in range(scenario['reservations']):
+            end = now + datetime.timedelta(days=backend.random.randint(-20, 540))
+            ri = {
+                u'ReservedInstancesId': backend.next_id('ri'), u'AvailabilityZone': '%sa' % region,
+                u'InstanceType': backend.random.choice(instance_types),
+                u'ProductDescription': '%s (Amazon VPC)' % backend.random.choice(platforms),
+                u'InstanceTenancy': u'default', u'Scope': backend.random.choice([u'Availability Zone', u'Region']),
+                u'InstanceCount': backend.random.randint(1, 10), u'Duration': 31536000,
+                u'State': u'active' if end > now else u'retired', u'End': end,
+                u'Tags': [{u'Key': u'env', u'Value': backend.random.choice(['prd', 'stg', 'dev'])}]}
+            # As in DescribeReservedInstances, regional reservations have no availability zone.
+            if ri[u'Scope'] == u'Region':
+                del ri[u'AvailabilityZone']
+            backend.region(region)['reserved_instances'].append(ri)
+        for instance in range(scenario.get('instances', 0)):
+            instance_id = backend.next_id('i')
+            backend.region(region)['instances'][instance_id] = {
+                u'InstanceId': instance_id, u'State': {u'Name': u'running'},
+                u'InstanceType': backend.random.choice(instance_types), u'PlatformDetails': backend.random.choice(platforms),
+                u'Placement': {u'AvailabilityZone': '%s%s' % (region, backend.random.choice('ab')), u'Tenancy': u'default'}}
+
+
+
+# ThreadSampler
+#
+# Samples the number of live threads in the background, keeping the highest seen.
+class ThreadSampler(threading.Thread):
+    def __init__(self, interval=0.01):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = threading.active_count()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, threading.active_count())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+
+# measure_import
+#
+# Time a cold start of a scenario's script in a fresh interpreter, as this one has already imported botocore: the
+# import of the script, then the construction of its first client (offline), which is when boto3 gets imported.
+# wall_time is the two together. Peak memory is that of the fresh interpreter, baseline_rss_kb once imported.
+import_probe = """import json, resource, sys, time
+started = time.time()
+module = __import__(sys.argv[1])
+imported = time.time()
+import_rss, modules = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(sys.modules)
+module.get_client('ec2', 'eu-west-1')
+print json.dumps({'import_time': imported - started, 'first_client_time': time.time() - imported, 'modules': modules,
+                  'import_rss_kb': import_rss, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+"""
+
+def measure_import(scenario):
+    output = subprocess.check_output([sys.executable, '-c', import_probe, scenario['script']], cwd=scripts_dir, stderr=open(os.devnull, 'w'))
+    probe = json.loads(output.strip().splitlines()[-1])
+    return {'scenario': scenario,
+            'wall_time': round(probe['import_time'] + probe['first_client_time'], 3),
+            'import_time': round(probe['import_time'], 4),
+            'first_client_time': round(probe['first_client_time'], 4),
+            'modules_imported': probe['modules'],
+            'api_calls': {},
+            'total_api_calls': 0,
+            'baseline_rss_kb': probe['import_rss_kb'],
+            'peak_rss_kb': probe['peak_rss_kb'],
+            'peak_threads': 1}
+
+
+
+# run_scenario
+#
+# Run one scenario in this process and return its measurements.
+def run_scenario(name):
+    scenario = scenarios[name]
+    if scenario.get('import_only'):
+        return measure_import(scenario)
+    sys.path.insert(0, scripts_dir)
+    backend = FakeBackend(scenario)
+    module = __import__(scenario['script'])
+    module.get_client = backend.get_client
+    for setting, value in scenario.get('settings', {}).items():
+        setattr(module, setting, value)
+
+    event = {}
+    if scenario['script'] == 'photographer':
+        backend.objects[module.s3_file] = build_photographer_account(backend, scenario)
+        if scenario.get('events'):
+            event = build_events(backend, scenario)
+    else:
+        build_reservations(backend, scenario)
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sampler = ThreadSampler()
+    sampler.start()
+    start = time.time()
+    for run in range(scenario.get('runs', 1)):
+        module.lambda_handler(event, None)
+    wall_time = time.time() - start
+    peak_threads = sampler.stop()
+
+    return {'scenario': scenario,
+            'wall_time': round(wall_time, 3),
+            'api_calls': backend.calls,
+            'total_api_calls': sum(backend.calls.values()),
+            'baseline_rss_kb': baseline_rss,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_threads': peak_threads}
+
+
+
+# current_commit
+#
+# The commit being benchmarked, marked dirty if the working tree has uncommitted changes.
+def current_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchmark_dir).strip()
+        if subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=benchmark_dir).strip():
+            commit += '-dirty'
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+
+# compare
+#
+# Print the change in wall time, API calls, peak memory and threads of each scenario between two result files.
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print '%-24s %22s %22s %22s %14s' % ('scenario (%s -> %s)' % (old['commit'], new['commit']), 'wall time (s)', 'API calls', 'peak RSS (KB)', 'threads')
+    for name in sorted(set(old['results']) & set(new['results'])):
+        row = [name]
+        for key in ('wall_time', 'total_api_calls', 'peak_rss_kb', 'peak_threads'):
+            before, after = old['results'][name][key], new['results'][name][key]
+            change = '%+.0f%%' % (100.0 * (after - before) / before) if before else 'n/a'
+            row.append('%s -> %s (%s)' % (before, after, change))
+        print '%-24s %22s %22s %22s %14s' % tuple(row)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the sheepherding scripts against a synthetic account.')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run (default: all of %s)' % ', '.join(sorted(scenarios)))
+    parser.add_argument('--output', help='results file (default: benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.child:
+        # The scripts print progress to stdout, which is reserved for the measurements.
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        result = run_scenario(args.child)
+        json.dump(result, stdout)
+        return
+
+    commit = current_commit()
+    results = {}
+    for name in args.scenarios or sorted(scenarios):
+        # Each scenario gets a fresh process so that peak memory and module level caches are its own.
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', name], stderr=open(os.devnull, 'w'))
+        results[name] = json.loads(output)
+        print '%s: %ss, %s API calls, peak RSS %s KB, %s threads' % (name, results[name]['wall_time'], results[name]['total_api_calls'],
+                                                                  results[name]['peak_rss_kb'], results[name]['peak_threads'])
+
+    output_file = args.output or os.path.join(results_dir, '%s.json' % commit)
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output_file))):
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)))
+    with open(output_file, 'w') as f:
+        json.dump({'commit': commit, 'python': sys.version.split()[0], 'timestamp': datetime.datetime.now(tzutc()).isoformat(),
+                   'results': results}, f, indent=2, sort_keys=True)
+    print 'Results written to %s' % output_file
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,24 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import ConfigParser,  StringIO, logging, Queue, sys, threading
-import boto3, botocore.exceptions
+import array, bisect, calendar, collections, ConfigParser, fnmatch, importlib, json,  StringIO, logging, Queue, sys, threading
 import datetime, time
-from dateutil.tz import tzlocal, tzutc
 
 # photographer.py
 #
 #    Author: Joe Beard <joe.beard@4a42.org>
 #
 #    This program is designed to take backups of AWS assets each time it is run and
-#    selectively retain backups based on a policy. The policy can define the following:
+#    selectively retain backups based on a policy. Backups are not waited for, they only count toward the policy
+#    once a later run finds them completed, failed backups are removed. The policy can define the following:
 #       Number of most recent backups to be held (including the backup taken on this run)
 #       Number of days to hold the oldest backup for each day
 #       Number of 7 day periods to hold the oldest backup for each period (weeks)
 #       Number of 31 day periods to hold the oldest backup for each period (months)
+#    Assets are listed by id or instance name, or matched by a volume_selector / instance_selector, see
+#    compile_selector. An asset matched by several policies is backed up once, under the stricter retention.
+#    Policies run in the Lambda's own account unless they name others from account_roles, see compile_policy.
+#    Given a dr_region, the backups a policy keeps are also copied there and retained independently, see replicate.
 #
 #    This program is free software: you can redistribute it and/or modify
 #    it under the terms of the GNU General Public License version 3, as
@@ -32,10 +35,18 @@ from dateutil.tz import tzlocal, tzutc
 #    This lambda script has the following configuration requirements:
 #    * Run with a IAM role that has the following permissions
 #      * Access config file in S3
-#      * describe ec2 instances
+#      * Read and write the state file in S3 (if s3_state_file is set)
+#      * describe ec2 instances and regions
+#      * copy snapshots and images into the dr_region of any policy
+#      * Assume the roles in account_roles, each allowing the same ec2 actions in its account
 #      * Send email using SES
-#    * Scheduled to run periodically (it will not react to the event info supplied)
-#    * Timeout may need to be increased depending on the number of objects to be backed up
+#    * Scheduled to run periodically, which scans every policy in full. It can also be the target of EventBridge
+#      rules for EBS Snapshot Notification, EC2 AMI State Change, Tag Change on Resource and Photographer Backup
+#      events, handling only the assets they name, see event_targets. Delivered through an SQS queue with a batching
+#      window, bursts of events arrive together and are described with one call per region. The state file is
+#      rewritten by every invocation, so reserve a concurrency of 1 when both are used.
+#    * Timeout may need to be increased depending on the number of objects to be backed up. Assets not backed up, or
+#      not processed, before the timeout (less time_safety_margin) are backed up, or processed, first by the next run.
 
 
 logging_level = logging.INFO
@@ -43,6 +54,174 @@ dry_run = False
 
 s3_bucket = '4a42-ops'
 s3_file = 'photographer.conf'
+# State kept between runs in the same bucket, set to None to evaluate every asset from scratch on each run.
+s3_state_file = 'photographer.state.json'
+
+# Regions policies may operate in, None for those enabled in the account (see known_regions) which are rediscovered
+# every region_cache_ttl seconds, and the retention limits of a policy which does not declare them.
+aws_regions = None
+region_cache_ttl = 86400
+policy_retention_defaults = {'most_recent':5, 'days':7, 'weeks':4, 'months':2 }
+
+# Roles in other accounts which policies may back up, assumed through STS. Assumed credentials are renewed once they
+# are within credential_refresh_margin seconds of expiring, longer than an invocation can run.
+account_roles = []
+credential_refresh_margin = 900
+
+# Concurrency limits for the worker pool, overall and against any single region of an account, and the calls of an
+# operation which may be in flight against a region at once.
+max_workers = 10
+max_workers_per_region = 4
+operation_limits = {'create_snapshot': 4, 'create_image': 2}
+
+# Deletion stage limits: calls per second (and burst) against each region, the threads making them, attempts when
+# throttled and the seconds allowed before outstanding deletions are left for the next run.
+deletion_rate = 5
+deletion_burst = 10
+deletion_workers = 4
+deletion_attempts = 5
+deletion_time_budget = 120
+
+# Region completed backups are copied to for disaster recovery, None for no copies unless a policy names its own
+# dr_region. Copies are started at copy_rate calls per second (and burst) against each destination region, with no
+# more than copy_limits of each kind in progress there at once, and any missing after copy_timeout seconds are
+# started again.
+dr_region = None
+copy_rate = 2
+copy_burst = 5
+copy_limits = {'snapshot': 20, 'image': 10}
+copy_timeout = 3600
+
+# Days an asset no policy selects any longer stays in the state file, see prune_state.
+state_prune_days = 30
+
+# Seconds of Lambda time to hold back. Once less than this remains no more assets are started, and the deletion stage
+# stops at half of it, leaving time to save the state.
+time_safety_margin = 60
+
+# Share of the time budget backups may take. Once it has gone no more backups are started, leaving the rest of the
+# budget for retention.
+backup_time_share = 0.5
+
+# States of a backup (snapshot or image) which count toward retention, which are still being created and which
+# have failed. Backups in any other state are left alone.
+confirmed_states = ('completed', 'available')
+pending_states = ('pending', 'transient')
+failed_states = ('error', 'failed', 'invalid')
+
+# The most tags EC2 accepts on a resource.
+max_tags = 50
+
+# Namespace of the CloudWatch metrics emitted at the end of each run.
+metrics_namespace = 'Photographer'
+
+worker_pool = None
+state_store = None
+deletion_stage = None
+replication_stage = None
+# Start of the current invocation in epoch seconds. Every retention decision of the run is made as of this time.
+run_started = None
+
+# Per account and region inventories of the current invocation, see get_inventory, and the most values EC2 accepts in
+# one describe filter.
+inventories = {}
+filter_values_limit = 200
+inventory_locks = {}
+inventory_lock = threading.Lock()
+
+# Parsed config files, bucket regions and the enabled regions, kept across warm invocations. See load_config,
+# s3_request and known_regions.
+config_cache = {}
+bucket_regions = {}
+discovered_regions = {}
+
+# Clients and assumed role credentials shared across warm invocations, see get_client, and the Metrics they report to.
+clients = {}
+client_lock = threading.Lock()
+credentials = {}
+credential_lock = threading.Lock()
+client_stats = {'created': 0, 'reused': 0}
+
+# Default retention limits and the length in days of each window used by the limits.
+retention_defaults = {'most_recent':{'default':5},
+                      'days'  :{'default':7, 'number_of_days':1 },
+                      'weeks' :{'default':4, 'number_of_days':7 },
+                      'months':{'default':6, 'number_of_days':31}
+                      }
+retention_reason_names = {'days':'day', 'weeks':'week', 'months':'month'}
+retention_reason_order = ['most_recent', 'day', 'week', 'month']
+
+# retained_positions
+#
+# The core of the retention engine. Given an ascending list of creation times, either datetimes or epoch seconds,
+# returns a dictionary of position -> reason for those retained. The oldest time in each day/week/month window is
+# found with a bisect, which makes the calculation O(n log n) instead of scanning every time for every window.
+# midnight is the start of the current day and day the length of one, in the same units as the times.
+def retained_positions(ordered, retention_limits, midnight, day):
+    reasons = {}
+
+    #mark up the most recent required.
+    for position in range(len(ordered))[-retention_limits.get('most_recent', retention_defaults['most_recent']['default']):]:
+        reasons.setdefault(position, 'most_recent')
+
+    # For each limit (days, weeks, months), step through the windows and keep the oldest time in each. The first
+    # time at or after the start of the window is the oldest in scope if it falls before the end of the window.
+    for limit in ['days', 'weeks', 'months']:
+        window = day * retention_defaults[limit]['number_of_days']
+        for period in range(0, retention_limits.get(limit, retention_defaults[limit]['default'])):
+            start_time = midnight - window*period
+            index = bisect.bisect_left(ordered, start_time)
+            if index < len(ordered) and ordered[index] < start_time + window:
+                reasons.setdefault(index, retention_reason_names[limit])
+
+    return reasons
+
+
+
+# retention_reasons
+#
+# The retention engine behind dates_to_keep, over datetimes. The dates are copied and sorted once and the caller's
+# list is never modified.
+#
+# Returns a dictionary of retained date -> reason, where the reason is the first rule which selected the date
+# ('most_recent', 'day', 'week' or 'month').
+#
+def retention_reasons(dates=None, retention_limits=None, now_time=None):
+
+    if retention_limits is None:
+        retention_limits = {}
+    if not dates:
+        return {}
+    if now_time is None:
+        now_time = datetime.datetime.now(tz.tzutc())
+
+    now_time = datetime.datetime(now_time.year, now_time.month, now_time.day)
+
+    #check if dates are tz aware:
+    if dates[0].tzinfo is not None:
+        now_time = now_time.replace(tzinfo=tz.tzutc())
+
+    ordered_dates = sorted(dates)
+    positions = retained_positions(ordered_dates, retention_limits, now_time, datetime.timedelta(days=1))
+    reasons = {}
+    for position in sorted(positions, key=lambda position: retention_reason_order.index(positions[position])):
+        reasons.setdefault(ordered_dates[position], positions[position])
+    return reasons
+
+
+
+# retention_mask
+#
+# The retention engine over a column of creation times in epoch seconds, such as BackupHistory.created. Returns a
+# bytearray mask, 1 for each backup to keep under the retention limits. Backups created at the same moment share a
+# decision, as they do in dates_to_keep.
+def retention_mask(created, retention_limits, now):
+    order = sorted(range(len(created)), key=created.__getitem__)
+    ordered = [created[index] for index in order]
+    kept = set(ordered[position] for position in retained_positions(ordered, retention_limits, now - now % 86400, 86400))
+    return bytearray(created_time in kept for created_time in created)
+
+
 
 # dates_to_keep
 #
@@ -53,154 +232,1414 @@ s3_file = 'photographer.conf'
 #   the oldest date for each 7 day period in the last 'weeks', oldest in each now+7x to now+7(x+1) for x in range 0 to weeks
 #   the oldest date for each 31 day period in the last 'months'
 #
-# It should be noted with the months field, this is not strictly months as it is a 31 day period
+# It should be noted with the months field, this is not strictly months as it is a 31 day period. now_time defaults
+# to the time of the call.
 #
-def dates_to_keep(dates = None, retention_limits=None, now_time=datetime.datetime.now(tzutc())):
-    
-    defaults = {'most_recent':{'default':5},
-                'days'  :{'default':7, 'number_of_days':1 },
-                'weeks' :{'default':4, 'number_of_days':7 },
-                'months':{'default':6, 'number_of_days':31}
-                }
-    
-    now_time =  datetime.datetime.strptime(now_time.strftime("%Y-%m-%d"), "%Y-%m-%d")
-    
-    if retention_limits is None:
-        retention_limits = {}
-    if dates is None:
-        return []
-    
-    #check if dates are tz aware:
-    if dates[0].tzinfo is not None:
-        now_time = datetime.datetime(now_time.year, now_time.month, now_time.day, tzinfo=tzutc())
+def dates_to_keep(dates = None, retention_limits=None, now_time=None):
+    return sorted(retention_reasons(dates=dates, retention_limits=retention_limits, now_time=now_time))
 
-    date_selection = dict([(date, False) for date in dates])
-    
-    #mark up the most recent required.
-    dates.sort()
-    for date in dates[-retention_limits.get('most_recent', defaults['most_recent']['default']):]:
-        date_selection[date] = True
-
-    # For each limit (days, weeks, months), step through the limit, finding days in scope and marking
-    # the oldest as to be retained.
-    for limit in ['days','weeks','months']:
-        for day in range(0, retention_limits.get(limit,  defaults[limit]['default']) ):
-            start_time = now_time-datetime.timedelta(days=day*defaults[limit]['number_of_days'])
-            end_time = now_time-datetime.timedelta(days=(day-1)*defaults[limit]['number_of_days'])
-            try:
-                dates_in_scope = [date for date in date_selection if  start_time <= date < end_time]
-            except Exception:
-                print now_time, start_time, end_time
-                raise AttributeError()
-            try:
-                oldest_backup_in_scope = min(dates_in_scope)
-                date_selection[oldest_backup_in_scope] = True   
-            except ValueError as e:
-                pass
-        
-    returning_dates = [date for date in date_selection if date_selection[date] is True]
-    return returning_dates
 
 
+# Job
+#
+# A minimal future returned by WorkerPool.submit. Once the call has run, result holds its return value or exception
+# holds whatever it raised. A job fails if it raised or returned False (the convention used by the process_*
+# functions).
+class Job(object):
+    def __init__(self, description, aws_region, fn, args, kwargs):
+        self.description = description
+        self.aws_region = aws_region
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self.finished = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception as e:
+            logging.exception('%s: uncaught exception', self.description)
+            self.exception = e
+        finally:
+            self.finished.set()
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+    def succeeded(self):
+        return self.finished.is_set() and self.exception is None and self.result is not False
+
+
+
+# WorkerPool
+#
+# A bounded pool of worker threads running Jobs. At most max_workers calls run at once, and no more than
+# max_workers_per_region of those against any single region, so a large policy cannot flood one EC2 endpoint. Jobs
+# wait in a queue per region and a free worker takes the oldest job of a region below its limit, so a worker is
+# never tied up waiting on a busy region while jobs for other regions are ready.
+# Jobs making calls limited by operation_limits hold the region's operation_limit around each of them.
+# Jobs may submit further jobs; wait() returns once every job has finished and join() also stops the workers.
+class WorkerPool(object):
+    def __init__(self, workers=None, workers_per_region=None):
+        self.workers = workers or max_workers
+        self.workers_per_region = workers_per_region or max_workers_per_region
+        self.waiting = {}
+        self.running = collections.defaultdict(int)
+        self.submitted = 0
+        self.stopping = False
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.operation_limits = {}
+        self.active = 0
+        self.capacity = threading.Condition(self.lock)
+        self.threads = [threading.Thread(target=self._worker) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def operation_limit(self, aws_region, account, operation):
+        key = (pool_region(aws_region, account), operation)
+        with self.lock:
+            if key not in self.operation_limits:
+                self.operation_limits[key] = threading.BoundedSemaphore(operation_limits[operation])
+            return self.operation_limits[key]
+
+    # The oldest waiting job of a region below its limit, removed from its queue, or None. Called holding the lock.
+    def _next_job(self):
+        ready = [region for region in self.waiting if region is None or self.running[region] < self.workers_per_region]
+        if not ready:
+            return None
+        region = min(ready, key=lambda region: self.waiting[region][0][0])
+        sequence, job = self.waiting[region].popleft()
+        if not self.waiting[region]:
+            del self.waiting[region]
+        return job
+
+    def _worker(self):
+        while True:
+            with self.capacity:
+                job = self._next_job()
+                while job is None and not (self.stopping and not self.waiting):
+                    self.capacity.wait()
+                    job = self._next_job()
+                if job is None:
+                    return
+                self.running[job.aws_region] += 1
+            job.run()
+            with self.capacity:
+                self.running[job.aws_region] -= 1
+                self.active -= 1
+                self.capacity.notify_all()
+
+    def submit(self, description, aws_region, fn, args=(), kwargs=None):
+        job = Job(description, aws_region, fn, args, kwargs or {})
+        with self.capacity:
+            self.jobs.append(job)
+            self.active += 1
+            self.submitted += 1
+            self.waiting.setdefault(aws_region, collections.deque()).append((self.submitted, job))
+            self.capacity.notify_all()
+        return job
+
+    def wait_for_capacity(self, limit, timeout=None):
+        with self.capacity:
+            if self.active >= limit:
+                self.capacity.wait(timeout)
+            return self.active < limit
+
+    def wait(self):
+        with self.capacity:
+            while self.active:
+                self.capacity.wait()
+
+    def join(self):
+        self.wait()
+        with self.capacity:
+            self.stopping = True
+            self.capacity.notify_all()
+        for thread in self.threads:
+            thread.join()
+        return self.jobs
+
+    def summary(self):
+        succeeded = [job for job in self.jobs if job.succeeded()]
+        failed = [job for job in self.jobs if not job.succeeded()]
+        logging.info('Run complete: %s succeeded, %s failed.', len(succeeded), len(failed))
+        for job in failed:
+            logging.error('Failed: %s (%s)', job.description, job.exception if job.exception is not None else 'returned False')
+        return {'succeeded': [job.description for job in succeeded], 'failed': [job.description for job in failed]}
+
 
-# threaded
+
+# pool_region
+#
+# The key a region is limited under by the worker pool, prefixed by the account id for other accounts, see pooled.
+def pool_region(aws_region, account=None):
+    return aws_region and '%s:%s' % (account_id(account), aws_region) if account else aws_region
+
+
+
+# pooled
 #
-#Decorator to script to be multi-threaded
-def threaded(fn):
+# Decorator submitting each call to the worker pool of the current invocation instead of running it inline. The
+# call returns its Job, described by the function and the asset it was given. Work in other accounts is limited per
+# account and region, as that is how EC2 throttles it.
+def pooled(fn):
     def wrapper(*args, **kwargs):
-        threading.Thread(target=fn, args=args, kwargs=kwargs).start()
+        asset = kwargs.get('instance_id') or kwargs.get('volume_id') or getattr(kwargs.get('policy'), 'name', None)
+        if kwargs.get('account'):
+            asset = '%s@%s' % (asset, account_id(kwargs['account']))
+        return worker_pool.submit('%s(%s)' % (fn.__name__, asset), pool_region(kwargs.get('aws_region'), kwargs.get('account')), fn, args, kwargs)
     return wrapper
 
 
 
+# LazyModule
+#
+# Stands in for a module which is only imported once one of its attributes is first used, so boto3, botocore and
+# dateutil are not loaded during a cold start until the run needs them. Submodules, such as botocore.exceptions,
+# are imported on first use in the same way.
+class LazyModule(object):
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        try:
+            return getattr(self._module, attr)
+        except AttributeError:
+            return importlib.import_module('%s.%s' % (self._name, attr))
+
+boto3 = LazyModule('boto3')
+botocore = LazyModule('botocore')
+tz = LazyModule('dateutil.tz')
+
+
+
+# Metrics
+#
+# Per invocation instrumentation. Hooked into botocore's events on every client, it counts the calls, retries,
+# throttles and errors of each region and operation and keeps a histogram of their latency. phase() times a named
+# stage of the run, summing across threads when the stage runs in parallel, and count() adds to a named count of the
+# run. emit() prints everything, along with any counts passed to it, as a single CloudWatch embedded metric format
+# (EMF) line. CloudWatch Logs turns the totals into metrics while the per operation breakdown stays queryable with
+# Logs Insights.
+class Metrics(object):
+    latency_buckets = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+    throttling_errors = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'SlowDown')
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.phases = {}
+            self.counts = {}
+            self.started = time.time()
+
+    def register(self, client):
+        client.meta.events.register('before-call', self.before_call)
+        client.meta.events.register('after-call', self.after_call)
+        client.meta.events.register('needs-retry', self.needs_retry)
+
+    def _operation(self, region, operation):
+        key = '%s:%s' % (region, operation)
+        if key not in self.operations:
+            self.operations[key] = {'calls': 0, 'retries': 0, 'throttles': 0, 'errors': 0,
+                                    'latency_ms': [0] * (len(self.latency_buckets) + 1)}
+        return self.operations[key]
+
+    def before_call(self, context=None, **kwargs):
+        if context is not None:
+            context['metrics_started'] = time.time()
+
+    def after_call(self, http_response=None, parsed=None, model=None, context=None, event_name=None, **kwargs):
+        latency = (time.time() - context.get('metrics_started', time.time())) * 1000 if context is not None else 0
+        region = context.get('client_region') if context is not None else None
+        with self.lock:
+            stats = self._operation(region, model.name if model is not None else event_name)
+            stats['calls'] += 1
+            stats['retries'] += (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            if http_response is not None and http_response.status_code >= 300:
+                stats['errors'] += 1
+            stats['latency_ms'][bisect.bisect_left(self.latency_buckets, latency)] += 1
+
+    def needs_retry(self, response=None, operation=None, request_dict=None, **kwargs):
+        if response is None:
+            return None
+        code = (response[1] or {}).get('Error', {}).get('Code')
+        if code in self.throttling_errors:
+            region = (request_dict or {}).get('context', {}).get('client_region')
+            with self.lock:
+                self._operation(region, operation.name if operation is not None else None)['throttles'] += 1
+        return None
+
+    def phase(self, name):
+        return MetricsPhase(self, name)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def emit(self, **properties):
+        with self.lock:
+            totals = dict((field, sum(stats[field] for stats in self.operations.values())) for field in ('calls', 'retries', 'throttles', 'errors'))
+            values = {'ApiCalls': totals['calls'], 'Retries': totals['retries'], 'Throttles': totals['throttles'],
+                      'Errors': totals['errors'], 'Duration': round(time.time() - self.started, 3)}
+            for name, seconds in self.phases.items():
+                values['Phase %s' % name] = round(seconds, 3)
+            values.update(self.counts)
+            values.update(properties)
+            record = {'_aws': {'Timestamp': int(time.time() * 1000),
+                               'CloudWatchMetrics': [{'Namespace': self.namespace, 'Dimensions': [[]],
+                                                      'Metrics': [{'Name': name, 'Unit': 'Seconds' if name == 'Duration' or name.startswith('Phase ') else 'Count'}
+                                                                  for name in sorted(values)]}]},
+                      'operations': self.operations,
+                      'latency_buckets_ms': self.latency_buckets}
+            record.update(values)
+        print json.dumps(record, sort_keys=True, default=str)
+        return record
+
+
+
+# MetricsPhase
+#
+# Context manager returned by Metrics.phase, adding the time spent inside it to the named phase.
+class MetricsPhase(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_phase(self.name, time.time() - self.started)
+        return False
+
+metrics = Metrics(metrics_namespace)
+
+
+
+# get_client
+#
+# Return a boto3 client from a module level cache keyed by (service, region, signature version, role). The cache
+# survives warm invocations, so the cost of constructing clients is only paid once per container. Construction
+# happens under a lock as boto3's default session is not thread safe. Clients use botocore's adaptive retry mode and
+# a connection pool with a connection for every thread which may share them: the workers, and the threads of the
+# deletion and replication stages (deletion_workers each). Given a role_arn the client works in that account.
+def get_client(service, aws_region=None, signature_version=None, role_arn=None):
+    key = (service, aws_region, signature_version, role_arn)
+    role_credentials = assumed_credentials(role_arn) if role_arn else {}
+    with client_lock:
+        if key in clients:
+            client_stats['reused'] += 1
+        else:
+            config = botocore.config.Config(signature_version=signature_version,
+                                            max_pool_connections=max(max_workers + 2 * deletion_workers, 10),
+                                            retries={'mode': 'adaptive', 'max_attempts': 10})
+            clients[key] = boto3.client(service, region_name=aws_region, config=config,
+                                        aws_access_key_id=role_credentials.get('AccessKeyId'),
+                                        aws_secret_access_key=role_credentials.get('SecretAccessKey'),
+                                        aws_session_token=role_credentials.get('SessionToken'))
+            metrics.register(clients[key])
+            client_stats['created'] += 1
+        return clients[key]
+
+
+
+# assumed_credentials
+#
+# Temporary credentials for a role in account_roles. They are assumed on first use and shared across warm invocations
+# until within credential_refresh_margin (or half their lifetime, if shorter) of expiring, when they are assumed again
+# and the clients built on the old ones are dropped.
+def assumed_credentials(role_arn):
+    with credential_lock:
+        cached = credentials.get(role_arn)
+        if cached is None or time.time() >= cached['Refresh']:
+            response = get_client('sts').assume_role(RoleArn=role_arn, RoleSessionName='photographer')[u'Credentials']
+            expiration = epoch(response[u'Expiration'])
+            cached = {'AccessKeyId': response[u'AccessKeyId'], 'SecretAccessKey': response[u'SecretAccessKey'],
+                      'SessionToken': response[u'SessionToken'], 'Expiration': expiration,
+                      'Refresh': expiration - min(credential_refresh_margin, (expiration - time.time()) / 2)}
+            credentials[role_arn] = cached
+            with client_lock:
+                for key in [key for key in clients if key[3] == role_arn]:
+                    del clients[key]
+        return cached
+
+
+
+# account_id
+#
+# The account id of a role ARN (arn:aws:iam::<account id>:role/<name>).
+def account_id(role_arn):
+    return role_arn.split(':')[4]
+
+
+
+# s3_request
+#
+# Make a request against an S3 bucket using a signature v4 client in the bucket's own region. The region is looked up
+# once and remembered across warm invocations, so requests do not fail against the default region first.
+def s3_request(bucket, operation, **kwargs):
+    if bucket not in bucket_regions:
+        location = get_client('s3').get_bucket_location(Bucket=bucket)[u'LocationConstraint']
+        bucket_regions[bucket] = {None: 'us-east-1', 'EU': 'eu-west-1'}.get(location, location)
+    return getattr(get_client('s3', bucket_regions[bucket], 's3v4'), operation)(Bucket=bucket, **kwargs)
+
+
+
+# known_regions
+#
+# The regions policies may operate in: aws_regions, or if that is None the regions enabled in the Lambda's own account
+# as listed by describe_regions, which are kept across warm invocations for region_cache_ttl seconds. Returns None
+# when they cannot be discovered, and policies are then not checked against them.
+def known_regions():
+    if aws_regions is not None:
+        return aws_regions
+    if time.time() - discovered_regions.get('time', 0) >= region_cache_ttl:
+        try:
+            response = get_client('ec2', 'us-east-1').describe_regions()
+        except botocore.exceptions.ClientError as e:
+            logging.error('Could not discover the enabled regions, policy regions will not be checked (%s).', e)
+            return None
+        discovered_regions.update(time=time.time(), regions=sorted(region[u'RegionName'] for region in response[u'Regions']))
+    return discovered_regions['regions']
+
+
+
+# PolicyError
+#
+# Raised when a section of the config file is not a valid policy.
+class PolicyError(ValueError):
+    pass
+
+
+
+# Policy
+#
+# A validated, immutable policy compiled from a section of the config file. retention_limits is held as sorted
+# (limit, value) pairs, limits() returns them as the dictionary dates_to_keep expects. accounts holds the role ARN of
+# each account the policy runs in, None standing for the Lambda's own account.
+class Policy(collections.namedtuple('Policy', 'name aws_region retention_limits volume_ids instance_ids instance_names volume_selector instance_selector accounts dr_region')):
+    __slots__ = ()
+
+    def limits(self):
+        return dict(self.retention_limits)
+
+
+
+# compile_selector
+#
+# Parse a selector expression, a whitespace separated list of terms which a resource must all match:
+#   tag:Key          - the resource has the tag Key
+#   tag:Key=Value    - the resource has the tag Key with the value Value
+#   attached:Pattern - (volumes only) the volume is attached to an instance whose id or Name matches Pattern
+# Keys, values and patterns may use * and ? wildcards. Prefixing a term with ! excludes the resources it matches,
+# at least one term must not be an exclusion. Returns a tuple of (negate, kind, key, pattern) terms.
+def compile_selector(section, name, expression, kinds):
+    terms = []
+    for term in expression.split():
+        negate = term.startswith('!')
+        kind, separator, argument = term.lstrip('!').partition(':')
+        if kind not in kinds or not argument:
+            raise PolicyError('%s has an invalid %s term: %s' % (section, name, term))
+        if kind == 'tag':
+            key, equals, pattern = argument.partition('=')
+            terms.append((negate, kind, key, pattern if equals else None))
+        else:
+            terms.append((negate, kind, None, argument))
+    if terms and all(negate for negate, kind, key, pattern in terms):
+        raise PolicyError('%s has a %s which only excludes resources.' % (section, name))
+    return tuple(terms)
+
+
+
+# selector_matches
+#
+# Whether a volume or instance from the region inventory matches every term of a compiled selector.
+def selector_matches(terms, resource, inventory):
+    tags = [(tag[u'Key'], tag[u'Value']) for tag in resource.get(u'Tags', [])]
+    for negate, kind, key, pattern in terms:
+        if kind == 'tag':
+            matched = any(fnmatch.fnmatchcase(tag_key, key) and (pattern is None or fnmatch.fnmatchcase(tag_value, pattern))
+                          for tag_key, tag_value in tags)
+        else:
+            names = []
+            for attachment in resource.get(u'Attachments', []):
+                instance = inventory.instances.get(attachment[u'InstanceId'], {})
+                names.append(attachment[u'InstanceId'])
+                names.extend(tag[u'Value'] for tag in instance.get(u'Tags', []) if tag[u'Key'] == 'Name')
+            matched = any(fnmatch.fnmatchcase(name, pattern) for name in names)
+        if matched == negate:
+            return False
+    return True
+
+
+
+# compile_policy
+#
+# Build a Policy from a section of the config file, raising PolicyError if the section is not valid: it must name one
+# of the regions given (unless they are None), as must any dr_region other than its own, any retention limits must be whole numbers (at least 1 for most_recent, at least 0 otherwise), ids
+# must look like volume/instance ids, selectors must parse and the policy has to cover at least one asset.
+#
+# The accounts option lists the accounts to run in: 'self' for the Lambda's own account (the default), account ids
+# from account_roles, or 'all' for the Lambda's own account and every account in account_roles.
+def compile_policy(cp, section, regions=None):
+    def option(name, default=None):
+        try:
+            return cp.get(section, name).strip()
+        except ConfigParser.NoOptionError:
+            return default
+
+    def id_list(name, prefix):
+        values = option(name, 'None')
+        values = [] if values == 'None' else values.split()
+        invalid = [value for value in values if not value.startswith(prefix)]
+        if invalid:
+            raise PolicyError('%s has invalid %s: %s' % (section, name, ' '.join(invalid)))
+        return tuple(values)
+
+    aws_region = option('aws_region')
+    if aws_region is None:
+        raise PolicyError('%s does not specify a region, this is required.' % section)
+    if regions is not None and aws_region not in regions:
+        raise PolicyError('%s specified an invalid region (%s).' % (section, aws_region))
+
+    retention_limits = dict(policy_retention_defaults)
+    for limit in retention_limits:
+        value = option(limit)
+        if value is None:
+            logging.warning('%s does not declare %s number, assuming default of %s.', section, limit, retention_limits[limit])
+            continue
+        try:
+            retention_limits[limit] = int(value)
+        except ValueError:
+            raise PolicyError('%s has a non numeric %s (%s).' % (section, limit, value))
+        if retention_limits[limit] < (1 if limit == 'most_recent' else 0):
+            raise PolicyError('%s has an out of range %s (%s).' % (section, limit, value))
+
+    roles = dict((account_id(role_arn), role_arn) for role_arn in account_roles)
+    accounts = []
+    for account in option('accounts', 'self').split():
+        if account == 'all':
+            accounts.extend([None] + list(account_roles))
+        elif account == 'self':
+            accounts.append(None)
+        elif account in roles:
+            accounts.append(roles[account])
+        else:
+            raise PolicyError('%s names an account without a role in account_roles (%s).' % (section, account))
+
+    policy_dr_region = option('dr_region', dr_region)
+    if policy_dr_region == 'None' or policy_dr_region == aws_region:
+        policy_dr_region = None
+    if policy_dr_region is not None and regions is not None and policy_dr_region not in regions:
+        raise PolicyError('%s specified an invalid dr_region (%s).' % (section, policy_dr_region))
+
+    instance_names = option('instance_names', 'None')
+    policy = Policy(name=section, aws_region=aws_region, retention_limits=tuple(sorted(retention_limits.items())),
+                    volume_ids=id_list('volume_ids', 'vol-'), instance_ids=id_list('instance_ids', 'i-'),
+                    instance_names=tuple([] if instance_names == 'None' else instance_names.split()),
+                    volume_selector=compile_selector(section, 'volume_selector', option('volume_selector', ''), ('tag', 'attached')),
+                    instance_selector=compile_selector(section, 'instance_selector', option('instance_selector', ''), ('tag',)),
+                    accounts=tuple(sorted(set(accounts))), dr_region=policy_dr_region)
+    if not (policy.volume_ids or policy.instance_ids or policy.instance_names or policy.volume_selector or policy.instance_selector):
+        raise PolicyError('%s does not declare any volumes or instances.' % section)
+    return policy
+
+
+
 # load_config
 #
-# take a text file held in an S3 Bucket and load it into a ConfigParser object.
+# Fetch the config file from an S3 bucket and compile its sections into Policies. The result is cached across warm
+# invocations and revalidated with the object's ETag, so an unchanged config costs a single conditional request. It
+# is compiled again if the known regions have changed since.
+# Returns the valid policies and a dictionary of rejected section -> reason.
 def load_config(bucket=None, key=None):
     if bucket is None or key is None:
         raise AttributeError('Boom')
-        
-    
+
+    regions = known_regions()
+    cached = config_cache.get((bucket, key))
+    if cached is not None and cached['regions'] != regions:
+        cached = None
     try:
-        client = boto3.client('s3')
-        r = client.get_object(Bucket=bucket,Key=key)
-    except botocore.exceptions.ClientError as e: 
-        client = boto3.client('s3')
-        location = client.get_bucket_location(Bucket=bucket)[u'LocationConstraint']
-        session = boto3.session.Session(region_name=location)
-        client = session.client('s3', config= boto3.session.Config(signature_version='s3v4'))
-        r = client.get_object(Bucket=bucket,Key=key)
-
-    s = ''
-    chunk = r[u'Body'].read(1024*8)
-    while chunk:
-        s += chunk
-        chunk = r[u'Body'].read(1024*8)
+        if cached is None:
+            r = s3_request(bucket, 'get_object', Key=key)
+        else:
+            r = s3_request(bucket, 'get_object', Key=key, IfNoneMatch=cached['etag'])
+    except botocore.exceptions.ClientError as e:
+        if cached is not None and e.response['Error']['Code'] in ('304', 'NotModified'):
+            logging.info('%s is unchanged, using the cached policies.', key)
+            return cached['policies'], cached['rejected']
+        raise
+
     configparser = ConfigParser.ConfigParser()
-    configparser.readfp(StringIO.StringIO(s))
-    return configparser
+    configparser.readfp(StringIO.StringIO(r[u'Body'].read()))
 
+    policies, rejected = [], {}
+    for section in configparser.sections():
+        try:
+            policies.append(compile_policy(configparser, section, regions))
+        except PolicyError as e:
+            logging.error('Rejecting policy: %s', e)
+            rejected[section] = str(e)
 
+    config_cache[(bucket, key)] = {'etag': r.get(u'ETag'), 'policies': policies, 'rejected': rejected, 'regions': regions}
+    return policies, rejected
 
-# process_instance
+
+
+# epoch
 #
-# Actions to complete:
-#   Take AMI now
-#   Find all existing AMIs
-#   Remove those not required by policy
+# Convert a backup's creation time, either a datetime (naive datetimes are taken to be UTC) or an AMI CreationDate
+# string, to seconds since the epoch. Whole seconds unless fraction is set. CreationDate strings are sliced apart
+# rather than parsed with strptime, which is several times slower.
+def epoch(date, fraction=False):
+    if isinstance(date, datetime.datetime):
+        seconds = calendar.timegm(date.utctimetuple()) + date.microsecond / 1000000.0
+    else:
+        seconds = calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]), int(date[11:13]), int(date[14:16]), int(date[17:19])))
+        seconds += float('0' + date[19:-1])
+    return seconds if fraction else int(seconds)
+
+
+
+# StateStore
+#
+# Optional state persisted between runs as compact JSON in the same bucket as the config file. Each asset, keyed
+# region:asset_id, records the backups known after its last run (id -> creation time in epoch seconds), the ids
+# retained and the day that decision was made. A run compares the backups it finds against this to see what is new
+# or gone, and leaves an asset alone when nothing has changed since the last decision on the same day. Assets no
+# policy selects any longer are removed after a while, see prune_state.
+class StateStore(object):
+    version = 1
+
+    def __init__(self, bucket=None, key=None):
+        self.bucket = bucket
+        self.key = key
+        self.lock = threading.Lock()
+        self.data = {'version': self.version, 'assets': {}}
+
+    def load(self):
+        if self.key is None:
+            return self
+        try:
+            data = json.loads(s3_request(self.bucket, 'get_object', Key=self.key)[u'Body'].read())
+            if data.get('version') == self.version:
+                self.data = data
+            else:
+                logging.warning('Ignoring state file %s with unknown version %s.', self.key, data.get('version'))
+        except botocore.exceptions.ClientError as e:
+            logging.warning('No state loaded from %s, all assets will be fully evaluated (%s).', self.key, e)
+        return self
+
+    def save(self):
+        if self.key is None:
+            return
+        with self.lock:
+            body = json.dumps(self.data, separators=(',', ':'), sort_keys=True)
+        s3_request(self.bucket, 'put_object', Key=self.key, Body=body)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+
+    def asset(self, key):
+        with self.lock:
+            return dict(self.data['assets'].get(key, {}))
+
+    def update_asset(self, key, **values):
+        with self.lock:
+            self.data['assets'].setdefault(key, {}).update(values)
+
+    def update_item(self, key, field, item, value):
+        # A single entry of a dictionary in an asset's state, removed when value is None.
+        with self.lock:
+            items = self.data['assets'].setdefault(key, {}).setdefault(field, {})
+            if value is None:
+                items.pop(item, None)
+            else:
+                items[item] = value
+
+    def assets(self):
+        with self.lock:
+            return dict((key, dict(asset)) for key, asset in self.data['assets'].items())
+
+    def remove_asset(self, key):
+        with self.lock:
+            self.data['assets'].pop(key, None)
+
+
+
+# state_key
+#
+# The key an asset's state is stored under, region:asset_id, prefixed by the account id for other accounts.
+def state_key(aws_region, asset_id, account=None):
+    key = '%s:%s' % (aws_region, asset_id)
+    return '%s:%s' % (account_id(account), key) if account else key
+
+
+
+# backups_changed
 #
-@threaded
-def process_instance_id(policy='Unknown', aws_region=None, instance_id=None, retention_limits=None, ec2_client=None):  
+# Compare the backups found for an asset (id -> epoch seconds) against the state recorded by its last run, returning
+# False only when the same backups were already evaluated earlier today under the same rules (the retention limits
+# and dr_region), so a changed policy takes effect on its next run.
+def backups_changed(policy, key, backups, rules, today):
+    known = state_store.asset(key)
+    new = set(backups) - set(known.get('backups', {}))
+    gone = set(known.get('backups', {})) - set(backups)
+    logging.info('%s: %s has %s backups, %s new and %s gone since the last run.', policy, key, len(backups), len(new), len(gone))
+    if known.get('rules') != rules:
+        logging.info('%s: %s has different retention rules since the last run.', policy, key)
+        return True
+    return bool(new or gone) or known.get('decided') != today
+
+
+
+# prune_state
+#
+# Record when each asset in the state was last selected by a policy, and forget those no policy has selected for
+# state_prune_days, such as terminated instances or assets a policy no longer covers. An asset is kept while it
+# holds copies in a DR region, or has a backup still pending from within that time. Only a full scan in which every
+# policy succeeded knows which assets are selected.
+def prune_state(selected, now):
+    for key, asset in state_store.assets().items():
+        pending = [created for created in asset.get('pending', {}).values() if now - created < state_prune_days * 86400]
+        copies = [replica for replica in asset.get('replicas', {}).values() if replica['state'] != 'deleted']
+        if key in selected or 'selected' not in asset:
+            state_store.update_asset(key, selected=now)
+        elif now - asset['selected'] > state_prune_days * 86400 and not pending and not copies:
+            logging.info('Forgetting %s, not selected by any policy since %s.', key, time.strftime('%Y-%m-%d', time.gmtime(asset['selected'])))
+            state_store.remove_asset(key)
+
+
+
+# record_decision
+#
+# Store the retention decision made for an asset, along with the backups which remain after it and the rules it was
+# made under. Backups queued for deletion are treated as gone, any the deletion stage does not get to are
+# checkpointed separately.
+def record_decision(key, backups, kept, deleted, rules, today):
+    remaining = dict((backup_id, created) for backup_id, created in backups.items() if backup_id not in deleted)
+    state_store.update_asset(key, backups=remaining, kept=sorted(kept), rules=rules, decided=today)
+
+
+
+# TokenBucket
+#
+# Rate limiter allowing bursts of up to capacity calls, refilled at rate calls per second. take() blocks until a
+# token is available or the deadline passes, returning whether a token was taken.
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, deadline=None):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+
+# DeletionStage
+#
+# Deletions are not made by the asset workers themselves. They put deletion intents on this stage's queue, each a
+# dictionary of kind ('image' or 'snapshot'), id, aws_region, account, policy, asset and the asset's state key
+# (images also list the snapshots to delete once they are deregistered). retention is set on those a retention
+# decision made, and a copy in a DR region names the backup it is a replica of. A small pool of threads drains the
+# queue while the assets are processed, limited per account and region by a TokenBucket and backing off and retrying
+# when throttled.
+#
+# The stage stops at its deadline. Intents not yet deleted are left in deferred. Those retention decided are not
+# deleted by a later run as they stand, as by then a retention tag or the moving retention windows may keep the
+# backup: their assets are processed first by the next run instead, see lambda_handler. The rest, backups and copies
+# which failed and the snapshots behind deregistered images, are checkpointed and retried first on the next run. A deletion which fails for any reason, connection errors included once botocore's
+# retries run out, is logged and counted as failed, and the thread goes on to the next intent. In dry_run mode
+# nothing is deleted and finish() reports what would have been.
+class DeletionStage(object):
+    throttling_errors = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+    def __init__(self, deadline, workers=None, rate=None, burst=None):
+        self.deadline = deadline
+        self.rate = rate or deletion_rate
+        self.burst = burst or deletion_burst
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.queued = set()
+        self.closed = threading.Event()
+        self.deferred = []
+        self.would_delete = []
+        self.counts = {'deleted': 0, 'failed': 0}
+        self.threads = [threading.Thread(target=self._worker) for _ in range(workers or deletion_workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, intent):
+        # Checkpointed intents are queued again by the assets that still hold them, only delete each once.
+        with self.lock:
+            if intent['id'] in self.queued:
+                return
+            self.queued.add(intent['id'])
+        self.queue.put(intent)
+
+    def _bucket(self, aws_region, account=None):
+        with self.lock:
+            if (account, aws_region) not in self.buckets:
+                self.buckets[(account, aws_region)] = TokenBucket(self.rate, self.burst)
+            return self.buckets[(account, aws_region)]
+
+    def _call(self, intent, operation, **kwargs):
+        ec2_client = get_client('ec2', intent['aws_region'], role_arn=intent.get('account'))
+        for attempt in range(deletion_attempts):
+            if not self._bucket(intent['aws_region'], intent.get('account')).take(self.deadline):
+                return None
+            try:
+                return getattr(ec2_client, operation)(DryRun=dry_run, **kwargs)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in self.throttling_errors or attempt == deletion_attempts - 1:
+                    raise
+                logging.warning('%s: throttled, retrying in %ss', intent['id'], 2 ** attempt)
+                time.sleep(min(2 ** attempt, max(self.deadline - time.time(), 0)))
+        return None
+
+    def _delete(self, intent):
+        with metrics.phase('delete'):
+            if intent['kind'] == 'image':
+                response = self._call(intent, 'deregister_image', ImageId=intent['id'])
+            else:
+                response = self._call(intent, 'delete_snapshot', SnapshotId=intent['id'])
+        if response is None:
+            return False
+        logging.warning('%s: %s:%s deleted: %s - %s', intent['policy'], intent['aws_region'], intent['asset'], intent['id'], response)
+        if intent.get('replica'):
+            replica = state_store.asset(intent['key']).get('replicas', {}).get(intent['replica'])
+            if replica is not None:
+                state_store.update_item(intent['key'], 'replicas', intent['replica'], dict(replica, state='deleted'))
+        # Snapshots behind an image can only go once the image has been deregistered, nothing would keep them then.
+        for snapshot_id in intent.get('snapshots', []):
+            self.put(dict(intent, kind='snapshot', id=snapshot_id, snapshots=[], retention=False, replica=None))
+        return True
+
+    def _worker(self):
+        while True:
+            try:
+                intent = self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                if self.closed.is_set():
+                    return
+                continue
+            try:
+                if dry_run:
+                    with self.lock:
+                        self.would_delete.append(intent)
+                        self.would_delete.extend([dict(intent, kind='snapshot', id=snapshot_id, snapshots=[]) for snapshot_id in intent.get('snapshots', [])])
+                elif time.time() >= self.deadline or not self._delete(intent):
+                    with self.lock:
+                        self.deferred.append(intent)
+                else:
+                    with self.lock:
+                        self.counts['deleted'] += 1
+            except Exception as e:
+                logging.error('%s: %s:%s could not delete %s - %s', intent['policy'], intent['aws_region'], intent['asset'], intent['id'], e)
+                with self.lock:
+                    self.counts['failed'] += 1
+            finally:
+                self.queue.task_done()
+
+    def finish(self):
+        self.queue.join()
+        self.closed.set()
+        for thread in self.threads:
+            thread.join()
+        for intent in self.would_delete:
+            logging.warning('Dry run, would delete: %s %s (%s:%s for %s)', intent['kind'], intent['id'], intent['aws_region'], intent['asset'], intent['policy'])
+        if self.deferred:
+            logging.warning('Deletion time budget exhausted, %s deletions deferred to the next run.', len(self.deferred))
+        logging.info('Deletions: %s deleted, %s failed, %s deferred.', self.counts['deleted'], self.counts['failed'], len(self.deferred))
+        return dict(self.counts, deferred=len(self.deferred), would_delete=['%s %s' % (intent['kind'], intent['id']) for intent in self.would_delete])
+
+
+
+# ReplicationStage
+#
+# Copies backups to their dr_region, using the DeletionStage's queue, worker threads, rate limiting (at copy_rate)
+# and retries. The intents put on it come from replicate, each a source backup's kind, id, source_region, created
+# time and asset key, with aws_region the destination. A copy is started with copy_snapshot or copy_image against
+# the destination and recorded as a pending replica of its asset. No more than copy_limits copies of each kind are
+# left in progress in a destination at once, counting those started by earlier runs. The overflow, like anything not
+# started by the deadline, is left for a later run, which will find it still to be copied.
+#
+# confirm() runs before any asset is processed. It describes the pending copies of every asset, with one filtered
+# call per account, destination and kind, and marks those completed. Copies which failed, or have not appeared within
+# copy_timeout, are dropped so they are started again.
+class ReplicationStage(DeletionStage):
+    def __init__(self, deadline, workers=None):
+        self.in_progress = {}
+        DeletionStage.__init__(self, deadline, workers, copy_rate, copy_burst)
+        self.counts = {'copied': 0, 'confirmed': 0, 'failed': 0, 'deferred': 0}
+
+    def confirm(self):
+        groups = {}
+        for key, asset in state_store.assets().items():
+            for item, replica in asset.get('replicas', {}).items():
+                if replica['state'] == 'pending':
+                    groups.setdefault((replica['account'], replica['region'], replica['kind']), {})[replica['id']] = (key, item, replica)
+
+        for (account, aws_region, kind), copies in groups.items():
+            ec2_client = get_client('ec2', aws_region, role_arn=account)
+            try:
+                if kind == 'snapshot':
+                    found = dict((snapshot[u'SnapshotId'], (snapshot[u'State'], []))
+                                 for snapshot in paginate_matching(ec2_client, 'describe_snapshots', u'Snapshots', 'snapshot-id', copies, OwnerIds=['self']))
+                else:
+                    found = dict((image[u'ImageId'], (image[u'State'], [block[u'Ebs'][u'SnapshotId'] for block in image.get(u'BlockDeviceMappings', []) if u'SnapshotId' in block.get(u'Ebs', {})]))
+                                 for image in paginate_matching(ec2_client, 'describe_images', u'Images', 'image-id', copies, Owners=['self']))
+            except botocore.exceptions.ClientError as e:
+                logging.error('%s: could not check %s copies in progress - %s', aws_region, kind, e)
+                self.in_progress[(account, aws_region, kind)] = len(copies)
+                continue
+
+            for copy_id, (key, item, replica) in copies.items():
+                state, snapshots = found.get(copy_id, (None, []))
+                if state in confirmed_states:
+                    state_store.update_item(key, 'replicas', item, dict(replica, state='completed', snapshots=snapshots))
+                    self.counts['confirmed'] += 1
+                elif state in failed_states or (state is None and time.time() - replica['started'] > copy_timeout):
+                    logging.warning('%s: copy %s of %s to %s has failed, it will be copied again.', key, copy_id, replica.get('source', item), aws_region)
+                    state_store.update_item(key, 'replicas', item, None)
+                    self.counts['failed'] += 1
+                    if state is not None:
+                        deletion_stage.put({'kind': kind, 'id': copy_id, 'aws_region': aws_region, 'account': account, 'policy': 'replication', 'asset': key,
+                                            'key': key, 'snapshots': snapshots, 'retention': False})
+                else:
+                    self.in_progress[(account, aws_region, kind)] = self.in_progress.get((account, aws_region, kind), 0) + 1
+        metrics.count('CopiesConfirmed', self.counts['confirmed'])
+
+    def _copy(self, intent):
+        # Copies in progress only complete as far as this stage knows once a later run confirms them.
+        slot = (intent.get('account'), intent['aws_region'], intent['kind'])
+        with self.lock:
+            if self.in_progress.get(slot, 0) >= copy_limits[intent['kind']]:
+                return None
+            self.in_progress[slot] = self.in_progress.get(slot, 0) + 1
+
+        # The slot is given back unless a copy was started, whether the call was not made or raised.
+        description = 'Created by Photographer(%s) - Copy of %s from %s' % (intent['asset'], intent['id'], intent['source_region'])
+        response = None
+        try:
+            with metrics.phase('copy'):
+                if intent['kind'] == 'image':
+                    response = self._call(intent, 'copy_image', SourceRegion=intent['source_region'], SourceImageId=intent['id'],
+                                          Name='%s copy of %s from %s' % (intent['asset'], intent['id'], intent['source_region']), Description=description)
+                else:
+                    response = self._call(intent, 'copy_snapshot', SourceRegion=intent['source_region'], SourceSnapshotId=intent['id'], Description=description,
+                                          **tag_specification('snapshot', [{'Key': 'source_backup', 'Value': intent['id']}]))
+        finally:
+            if response is None:
+                with self.lock:
+                    self.in_progress[slot] -= 1
+        if response is None:
+            return None
+        copy_id = response.get(u'ImageId') or response[u'SnapshotId']
+        logging.info('%s: %s:%s copying %s to %s as %s', intent['policy'], intent['source_region'], intent['asset'], intent['id'], intent['aws_region'], copy_id)
+        state_store.update_item(intent['key'], 'replicas', replica_item(intent['aws_region'], intent['id']),
+                                {'id': copy_id, 'source': intent['id'], 'region': intent['aws_region'], 'account': intent.get('account'),
+                                 'kind': intent['kind'], 'created': intent['created'], 'state': 'pending', 'started': int(time.time())})
+        return copy_id
+
+    def _worker(self):
+        while True:
+            try:
+                intent = self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                if self.closed.is_set():
+                    return
+                continue
+            try:
+                if dry_run:
+                    logging.warning('Dry run, would copy: %s %s (%s:%s for %s) to %s', intent['kind'], intent['id'], intent['source_region'], intent['asset'], intent['policy'], intent['aws_region'])
+                elif time.time() >= self.deadline or self._copy(intent) is None:
+                    with self.lock:
+                        self.counts['deferred'] += 1
+                else:
+                    with self.lock:
+                        self.counts['copied'] += 1
+            except Exception as e:
+                logging.error('%s: %s:%s could not copy %s to %s - %s', intent['policy'], intent['source_region'], intent['asset'], intent['id'], intent['aws_region'], e)
+                with self.lock:
+                    self.counts['failed'] += 1
+            finally:
+                self.queue.task_done()
+
+    def finish(self):
+        self.queue.join()
+        self.closed.set()
+        for thread in self.threads:
+            thread.join()
+        if self.counts['deferred']:
+            logging.warning('%s copies could not be started and are left for a later run.', self.counts['deferred'])
+        logging.info('Copies: %s started, %s confirmed, %s failed, %s deferred.', self.counts['copied'], self.counts['confirmed'], self.counts['failed'], self.counts['deferred'])
+        return dict(self.counts)
+
+
+
+# paginate
+#
+# Yield every item under result_key for an EC2 describe call, following the paginator where botocore provides one
+# so that results past the first page are not silently dropped.
+def paginate(ec2_client, operation, result_key, **kwargs):
+    if ec2_client.can_paginate(operation):
+        for page in ec2_client.get_paginator(operation).paginate(**kwargs):
+            for item in page.get(result_key, []):
+                yield item
+    else:
+        for item in getattr(ec2_client, operation)(**kwargs).get(result_key, []):
+            yield item
+
+
+
+# paginate_matching
+#
+# paginate, limited to the resources for which the filter name has one of values. The values are sent
+# filter_values_limit at a time, the most EC2 accepts in one filter, and nothing is described when there are none.
+def paginate_matching(ec2_client, operation, result_key, name, values, **kwargs):
+    values = sorted(values)
+    for start in range(0, len(values), filter_values_limit):
+        filters = kwargs.get('Filters', []) + [{'Name': name, 'Values': values[start:start + filter_values_limit]}]
+        for item in paginate(ec2_client, operation, result_key, **dict(kwargs, Filters=filters)):
+            yield item
+
+
+
+# BackupHistory
+#
+# The backups of one asset held as columns rather than boto3 response dictionaries: parallel arrays of backup ids,
+# creation times in epoch seconds and flags, plus the snapshots behind each image. A backup's flags hold its state
+# (STATE_CONFIRMED, STATE_PENDING, STATE_FAILED or STATE_OTHER) and RETENTION_TAGGED when it carries a retention tag.
+# The inventory builds these as it pages through describe_snapshots and describe_images, so no more than a page of
+# full responses is held at any time.
+class BackupHistory(object):
+    __slots__ = ('ids', 'created', 'flags', 'snapshots')
+    STATE_CONFIRMED, STATE_PENDING, STATE_FAILED, STATE_OTHER = 0, 1, 2, 3
+    STATE_MASK = 3
+    RETENTION_TAGGED = 4
+
+    def __init__(self):
+        self.ids = []
+        self.created = array.array('d')
+        self.flags = bytearray()
+        self.snapshots = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, backup_id, created, state, tags, snapshots=()):
+        if state in confirmed_states:
+            flags = self.STATE_CONFIRMED
+        elif state in pending_states:
+            flags = self.STATE_PENDING
+        elif state in failed_states:
+            flags = self.STATE_FAILED
+        else:
+            flags = self.STATE_OTHER
+        if any(tag[u'Key'].startswith('retention') for tag in tags):
+            flags |= self.RETENTION_TAGGED
+        self.ids.append(backup_id)
+        self.created.append(created)
+        self.flags.append(flags)
+        self.snapshots.append(tuple(snapshots))
+
+    def state(self, index):
+        return self.flags[index] & self.STATE_MASK
+
+    def with_state(self, state):
+        return [index for index, flags in enumerate(self.flags) if flags & self.STATE_MASK == state]
+
+
+
+# RegionInventory
+#
+# A single paginated sweep of the instances, volumes, snapshots and images in a region, indexed in memory so the
+# per-asset workers can look up everything they need without making describe calls of their own. loaded is the
+# time the sweep started, backups taken after it are not in the inventory:
+#   instances           - instance id -> instance
+#   instances_by_name   - Name tag -> [instances]
+#   volumes             - volume id -> volume
+#   snapshots_by_volume - volume id -> BackupHistory of the snapshots taken by photographer
+#   images_by_instance  - source_instance tag -> BackupHistory of the images owned by this account
+#
+# Given a scope, see event_targets, only the assets named by it are described: its volumes and instances, the
+# instances behind its images and the instances its volumes are attached to (for attached: selectors). Each kind is
+# a single filtered describe however many assets the scope names. targets then holds the volume and instance ids the
+# scope is about, those whose backups are described.
+class RegionInventory(object):
+    def __init__(self, aws_region, ec2_client, scope=None):
+        started = time.time()
+        self.loaded = started
+        self.aws_region = aws_region
+        self.instances = {}
+        self.instances_by_name = {}
+        self.volumes = {}
+        self.snapshots_by_volume = {}
+        self.images_by_instance = {}
+        self.targets = None
+
+        snapshot_filter = {'Name': 'description', 'Values': ['Created by Photographer*']}
+        if scope is None:
+            for reservation in paginate(ec2_client, 'describe_instances', u'Reservations'):
+                for instance in reservation[u'Instances']:
+                    self._add_instance(instance)
+            for volume in paginate(ec2_client, 'describe_volumes', u'Volumes'):
+                self.volumes[volume[u'VolumeId']] = volume
+            snapshots = paginate(ec2_client, 'describe_snapshots', u'Snapshots', OwnerIds=['self'], Filters=[snapshot_filter])
+            images = paginate(ec2_client, 'describe_images', u'Images', Owners=['self'], Filters=[{'Name': 'tag-key', 'Values': ['source_instance']}])
+        else:
+            instance_ids = set(scope['instances'])
+            for image in paginate_matching(ec2_client, 'describe_images', u'Images', 'image-id', scope['images'], Owners=['self']):
+                instance_ids.update(tag[u'Value'] for tag in image.get(u'Tags', []) if tag[u'Key'] == 'source_instance')
+            attached = set()
+            for volume in paginate_matching(ec2_client, 'describe_volumes', u'Volumes', 'volume-id', scope['volumes']):
+                self.volumes[volume[u'VolumeId']] = volume
+                attached.update(attachment[u'InstanceId'] for attachment in volume.get(u'Attachments', []))
+            for reservation in paginate_matching(ec2_client, 'describe_instances', u'Reservations', 'instance-id', instance_ids | attached):
+                for instance in reservation[u'Instances']:
+                    self._add_instance(instance)
+            self.targets = set(self.volumes) | instance_ids
+            snapshots = paginate_matching(ec2_client, 'describe_snapshots', u'Snapshots', 'volume-id', self.volumes, OwnerIds=['self'], Filters=[snapshot_filter])
+            images = paginate_matching(ec2_client, 'describe_images', u'Images', 'tag:source_instance', instance_ids, Owners=['self'])
+
+        for snapshot in snapshots:
+            if not snapshot[u'Description'].startswith('Created by Photographer'):
+                continue
+            history = self.snapshots_by_volume.get(snapshot[u'VolumeId'])
+            if history is None:
+                history = self.snapshots_by_volume[snapshot[u'VolumeId']] = BackupHistory()
+            history.add(snapshot[u'SnapshotId'], epoch(snapshot[u'StartTime'], fraction=True), snapshot.get(u'State'), snapshot.get(u'Tags', []))
+
+        for image in images:
+            for tag in image.get(u'Tags', []):
+                if tag[u'Key'] == 'source_instance':
+                    history = self.images_by_instance.get(tag[u'Value'])
+                    if history is None:
+                        history = self.images_by_instance[tag[u'Value']] = BackupHistory()
+                    history.add(image[u'ImageId'], epoch(image[u'CreationDate'], fraction=True), image.get(u'State'), image.get(u'Tags', []),
+                                [block[u'Ebs'][u'SnapshotId'] for block in image.get(u'BlockDeviceMappings', []) if u'SnapshotId' in block.get(u'Ebs', {})])
+
+        logging.info('%s: inventory loaded %s instances, %s volumes, %s snapshots and %s images.', aws_region,
+                     len(self.instances), len(self.volumes),
+                     sum(len(snapshots) for snapshots in self.snapshots_by_volume.values()),
+                     sum(len(images) for images in self.images_by_instance.values()))
+        metrics.add_phase('inventory', time.time() - started)
+
+    def _add_instance(self, instance):
+        self.instances[instance[u'InstanceId']] = instance
+        for tag in instance.get(u'Tags', []):
+            if tag[u'Key'] == 'Name':
+                self.instances_by_name.setdefault(tag[u'Value'], []).append(instance)
+
+
+
+# get_inventory
+#
+# Return the RegionInventory for a region of an account, loading it on first use. Policies in the same region share
+# one sweep, and the lock ensures concurrent policies wait for it rather than loading it twice.
+def get_inventory(aws_region, ec2_client, account=None):
+    key = (account, aws_region)
+    with inventory_lock:
+        region_lock = inventory_locks.setdefault(key, threading.Lock())
+    with region_lock:
+        if key not in inventories:
+            inventories[key] = RegionInventory(aws_region, ec2_client)
+        return inventories[key]
+
+
+
+# tag_specification
+#
+# The TagSpecifications argument tagging a backup as it is created, so it is never left untagged if a later call
+# fails. EC2 rejects the whole call given tags reserved for AWS (aws: prefixed, as CloudFormation and Auto Scaling put
+# on their resources) or more than max_tags, so those are dropped, keeping the first max_tags of the rest. Empty when
+# there are no tags, which EC2 would also reject.
+def tag_specification(resource_type, tags):
+    tags = [tag for tag in tags if not tag['Key'].lower().startswith('aws:')][:max_tags]
+    return {'TagSpecifications': [{'ResourceType': resource_type, 'Tags': tags}]} if tags else {}
+
+
+
+# record_pending
+#
+# Remember a backup just taken as pending in its asset's state, see classify_backups.
+def record_pending(key, backup_id):
+    pending = state_store.asset(key).get('pending', {})
+    pending[backup_id] = int(time.time())
+    state_store.update_asset(key, pending=pending)
+    metrics.count('BackupsCreated')
+
+
+
+# classify_backups
+#
+# Split the backups in an asset's BackupHistory into those retention may count, completed snapshots and available
+# images, and those which failed, returning the indexes of each. Backups still being created are neither, they are
+# kept without counting toward any retention limit.
+#
+# The ids taken by earlier runs, held as pending in the asset's state, are confirmed against what the inventory now
+# shows. One the inventory does not show is still pending if it was taken after the inventory was loaded, otherwise
+# it has gone without completing. The creation time of the latest confirmed backup is kept as the asset's
+# last_success, which last_backup orders backups by.
+def classify_backups(policy, key, history, inventory):
+    confirmed = history.with_state(BackupHistory.STATE_CONFIRMED)
+    failed = history.with_state(BackupHistory.STATE_FAILED)
+
+    pending = state_store.asset(key).get('pending', {})
+    still_pending = {}
+    for backup_id, created in pending.items():
+        state = history.state(history.ids.index(backup_id)) if backup_id in history.ids else None
+        if state == BackupHistory.STATE_PENDING or (state is None and created >= int(inventory.loaded)):
+            still_pending[backup_id] = created
+        elif state == BackupHistory.STATE_CONFIRMED:
+            logging.info('%s: %s backup %s confirmed, %s minutes after it was taken.', policy, key, backup_id, int(inventory.loaded - created) // 60)
+            metrics.count('BackupsConfirmed')
+        elif state is None:
+            logging.warning('%s: %s backup %s disappeared before it completed.', policy, key, backup_id)
+            metrics.count('BackupsFailed')
+    for index in failed:
+        logging.error('%s: %s backup %s has failed, it will not count toward retention.', policy, key, history.ids[index])
+        metrics.count('BackupsFailed')
+    if still_pending != pending:
+        state_store.update_asset(key, pending=still_pending)
+    if confirmed:
+        state_store.update_asset(key, last_success=int(max(history.created[index] for index in confirmed)))
+    return confirmed, failed
+
+
+
+# backup_instance_id
+#
+# Take an AMI of an instance without waiting for it to become available. The image is tagged as it is created and
+# its id recorded as pending, see classify_backups.
+@pooled
+def backup_instance_id(policy='Unknown', aws_region=None, instance_id=None, retention_limits=None, ec2_client=None, account=None, dr_region=None):
     if aws_region is None or instance_id is None:
-        logging.error('%s: Could not process volume for %s-%s' % (policy, aws_region, volume_id))
+        logging.error('%s: Could not back up instance for %s-%s', policy, aws_region, instance_id)
         return False
     if ec2_client is None:
-        ec2_client = boto3.client('ec2', region_name=aws_region)
-    
-    logging.info('%s: Processing instance %s (%s)' % (policy, instance_id, aws_region))
-    try:
-        response = ec2_client.describe_instances(InstanceIds=[instance_id,])
-    except botocore.exceptions.ClientError as e:
-        logging.error('%s: %s' % (policy, e))
-        return False
-    try:
-        instance_data = response[u'Reservations'][0][u'Instances'][0]
-        if not instance_id == instance_data[u'InstanceId']:
-            raise AttributeError('Wrong Instance Returned')
-    except AttributeError as e:
-        logging.error('%s: %s' % (policy, e))
+        ec2_client = get_client('ec2', aws_region, role_arn=account)
+
+    inventory = get_inventory(aws_region, ec2_client, account)
+    instance_data = inventory.instances.get(instance_id)
+    if instance_data is None:
+        logging.error('%s: %s:%s could not be found', policy, aws_region, instance_id)
         return False
-    
-    now = datetime.datetime.now(tzlocal())
+
+    now = datetime.datetime.now(tz.tzlocal())
     try:
         instance_name = [tag[u'Value'] for tag in instance_data.get(u'Tags',[]) if tag[u'Key'] == 'Name'][0]
-    except KeyError:
+    except IndexError:
         instance_name = 'Not Named'
     
     #Build Name for AMI:
     ami_name = '%s (%s) %s - Taken by Photographer' % (instance_id, instance_name, now.isoformat())
     ami_name = ami_name[0:128]
     ami_name = "".join([c for c in ami_name if c.isalnum() or c in ' ().-/_'])
-    logging.info('%s: %s:%s using name: %s' % (policy, aws_region, instance_id, ami_name))
+    logging.info('%s: %s:%s using name: %s', policy, aws_region, instance_id, ami_name)
     
     #Build description for AMI
     ami_description = 'Automatic backup taken by Photographer - Instance Tags at time of image (%s)' % ". ".join(['%s-%s' %(tag[u'Key'], tag[u'Value']) for tag in  instance_data.get(u'Tags',[])])
     ami_description = ami_description[0:255]
     ami_description = "".join([c for c in ami_description if c.isalnum() or c in ' ().-/_'])
-    logging.info('%s: %s:%s using description: %s' % (policy, aws_region, instance_id, ami_description[0:255]))
-    
-    
-    #Create AMI
+    logging.info('%s: %s:%s using description: %s', policy, aws_region, instance_id, ami_description[0:255])
+
+    #Create AMI, tagged with its source instance
+    tags = [{'Key': 'source_instance','Value': instance_id}]
+    tags.extend(instance_data.get(u'Tags',[]))
     try:
-        response = ec2_client.create_image(DryRun=dry_run, InstanceId=instance_id, Name=ami_name, Description=ami_description, NoReboot=True )
-        new_ami_id = response[u'ImageId']
+        with worker_pool.operation_limit(aws_region, account, 'create_image'), metrics.phase('create'):
+            response = ec2_client.create_image(DryRun=dry_run, InstanceId=instance_id, Name=ami_name, Description=ami_description, NoReboot=True,
+                                               **tag_specification('image', tags))
+    except botocore.exceptions.ClientError as e:
+        logging.error('%s: %s - %s', policy, instance_id, e)
+        return False
+    record_pending(state_key(aws_region, instance_id, account), response[u'ImageId'])
+
 
-        #Tag AMI
-        tags = [{'Key': 'source_instance','Value': instance_id}]
-        tags.extend(instance_data.get(u'Tags',[])[0:9])
-        ec2_client.create_tags(DryRun=dry_run, Resources=[new_ami_id], Tags=tags)
+
+# backup_volume_id
+#
+# Take a snapshot of a volume without waiting for it to complete. The snapshot carries the volume's tags from the
+# moment it is created and its id is recorded as pending, see classify_backups.
+@pooled
+def backup_volume_id(policy='Unknown', aws_region=None, volume_id=None, retention_limits=None, ec2_client=None, account=None, dr_region=None):
+    if aws_region is None or volume_id is None:
+        logging.error('%s: Could not back up volume for %s-%s', policy, aws_region, volume_id)
+        return False
+    if ec2_client is None:
+        ec2_client = get_client('ec2', aws_region, role_arn=account)
+
+    # Make sure the volume actually exists and collect data to name the snapshot.
+    inventory = get_inventory(aws_region, ec2_client, account)
+    volume_data = inventory.volumes.get(volume_id)
+    if volume_data is None:
+        logging.error('%s: %s:%s could not be found', policy, aws_region, volume_id)
+        return False
+    
+    # Build a sensible description
+    if len(volume_data[u'Attachments']) > 0:
+        attachment = volume_data[u'Attachments'][0]
+        attachment_description = "Attached to %s:%s" % (attachment[u'InstanceId'], attachment[u'InstanceId'])
+    else:
+        attachment_description = 'Not Attached'
+    description = 'Created by Photographer(%s) - %s' % (volume_id, attachment_description)
+
+    # Take the snapshot, tagged appropriately
+    try: 
+        with worker_pool.operation_limit(aws_region, account, 'create_snapshot'), metrics.phase('create'):
+            response = ec2_client.create_snapshot(DryRun=dry_run, VolumeId=volume_id, Description=description,
+                                                  **tag_specification('snapshot', volume_data.get(u'Tags', [])))
     except botocore.exceptions.ClientError as e:
-        logging.error(e)
+        logging.error('%s: %s - %s', policy, volume_id, e)
+        return False  
+    record_pending(state_key(aws_region, volume_id, account), response[u'SnapshotId'])
+
+
+
+# apply_retention
+#
+# Decide which of an asset's confirmed backups, indexes into its BackupHistory, to keep: those the retention limits
+# select, computed as a mask over their creation times, and any carrying a retention tag. The rest are put on the
+# deletion stage as intents of the given kind, images along with the snapshots behind them.
+#
+# Returns the ids kept and the set of ids deleted.
+def apply_retention(kind, history, confirmed, retention_limits, intent):
+    keep = retention_mask([history.created[index] for index in confirmed], retention_limits, run_started)
+    kept, deleted = [], set()
+    for position, index in enumerate(confirmed):
+        if keep[position] or history.flags[index] & BackupHistory.RETENTION_TAGGED:
+            kept.append(history.ids[index])
+        else:
+            deletion = dict(intent, kind=kind, id=history.ids[index], retention=True)
+            if kind == 'image':
+                deletion['snapshots'] = list(history.snapshots[index])
+            deletion_stage.put(deletion)
+            deleted.add(history.ids[index])
+    logging.info('%s: %s:%s keeping %s backups, deleting %s.', intent['policy'], intent['aws_region'], intent['asset'], len(kept), len(deleted))
+    return kept, deleted
+
+
+
+# replica_item
+#
+# The key a copy is held under in its asset's replicas, region:source backup id, so a backup may have a copy in more
+# than one region.
+def replica_item(aws_region, backup_id):
+    return '%s:%s' % (aws_region, backup_id)
+
+
+
+# replicate
+#
+# Copy the backups an asset keeps in its own region to dr_region, and apply the retention limits to the copies there
+# with dates_to_keep, independently of the backups in the source region. Its copies are held in the asset's state as
+# replicas, see replica_item, each with its id, source backup id, region, account, kind, state, when the copy was
+# started, the creation time of the source backup (which retention goes by) and, for images, the snapshots behind the
+# copy. Copies still pending are not started again and only count toward retention once ReplicationStage.confirm
+# finds them completed. A copy counts toward retention until the deletion stage has deleted it, so one whose deletion
+# is deferred is decided again. Deleted copies are remembered until their source backup is gone too, so they are not
+# copied again.
+#
+# Copies left in a region which is no longer the dr_region, as when a policy's dr_region changes or is removed, are
+# deleted once their backup has a completed copy in the dr_region or is no longer kept.
+def replicate(kind, key, backups, kept, retention_limits, dr_region, intent):
+    replicas = {}
+    for item, replica in state_store.asset(key).get('replicas', {}).items():
+        # Copies recorded by source backup id alone are moved to their region:backup key.
+        if 'source' not in replica:
+            replica = dict(replica, source=item)
+            state_store.update_item(key, 'replicas', item, None)
+            item = replica_item(replica['region'], item)
+            state_store.update_item(key, 'replicas', item, replica)
+        replicas[item] = replica
+
+    if dr_region is not None:
+        for backup_id in kept:
+            if replica_item(dr_region, backup_id) not in replicas:
+                replication_stage.put(dict(intent, kind=kind, id=backup_id, created=backups[backup_id], source_region=intent['aws_region'],
+                                           aws_region=dr_region, key=key))
+
+    completed = dict((item, replica) for item, replica in replicas.items() if replica['state'] == 'completed' and replica['region'] == dr_region)
+    keep = set(dates_to_keep([datetime.datetime.utcfromtimestamp(replica['created']) for replica in completed.values()],
+                             retention_limits, datetime.datetime.utcfromtimestamp(run_started)))
+    for item, replica in replicas.items():
+        if replica['state'] != 'completed':
+            continue
+        if replica['region'] == dr_region:
+            delete = datetime.datetime.utcfromtimestamp(replica['created']) not in keep
+        else:
+            moved = dr_region is not None and replicas.get(replica_item(dr_region, replica['source']), {}).get('state') == 'completed'
+            delete = moved or replica['source'] not in kept
+        if delete:
+            deletion_stage.put(dict(intent, kind=kind, id=replica['id'], aws_region=replica['region'], account=replica['account'],
+                                    snapshots=replica.get('snapshots', []), retention=True, replica=item))
+    for item, replica in replicas.items():
+        if replica['state'] == 'deleted' and replica['source'] not in backups:
+            state_store.update_item(key, 'replicas', item, None)
+
+
+
+# process_instance
+#
+# Actions to complete:
+#   Find all existing AMIs
+#   Remove those not required by policy, counting only those which are available
+#
+@pooled
+def process_instance_id(policy='Unknown', aws_region=None, instance_id=None, retention_limits=None, ec2_client=None, account=None, dr_region=None):  
+    if aws_region is None or instance_id is None:
+        logging.error('%s: Could not process instance for %s-%s', policy, aws_region, instance_id)
+        return False
+    if ec2_client is None:
+        ec2_client = get_client('ec2', aws_region, role_arn=account)
+    
+    logging.info('%s: Processing instance %s (%s)', policy, instance_id, aws_region)
+    inventory = get_inventory(aws_region, ec2_client, account)
+    if instance_id not in inventory.instances:
+        logging.error('%s: %s:%s could not be found', policy, aws_region, instance_id)
+        return False
         
     # Clean up old AMIs   
     #    
@@ -208,216 +1647,425 @@ def process_instance_id(policy='Unknown', aws_region=None, instance_id=None, ret
     # this may result in older Images being deleted.
     # It is assumed there is a relatively low chance of collision.
     
-    # Get all existing AMIs of instance.
-    response = ec2_client.describe_images(DryRun=False,Owners=['self',],Filters=[{'Name': 'tag:source_instance','Values': [instance_id,]}])
-    existing_amis = response[u'Images']
-    # Convert to a list of datetimes
-    ami_dates = [datetime.datetime.strptime(ami[u'CreationDate'],'%Y-%m-%dT%H:%M:%S.%fZ') for ami in existing_amis]
-    # Calculate which datetimes are required to be retained under the retention policy
-    retained_dates = dates_to_keep(retention_limits=retention_limits, dates=ami_dates)
-
-    # No check each AMI in turn cleaning up those which are not needed
-    for ami in existing_amis:
-        # Check if this AMIs date is in the list we want to keep, if not remove it.
-        # It must either be the list of dates required by policy or tagged with a retention tag
-        
-        required_by_date = datetime.datetime.strptime(ami[u'CreationDate'],'%Y-%m-%dT%H:%M:%S.%fZ') in retained_dates
-        retention_tag_found = len([tag for tag in ami[u'Tags'] if tag[u'Key'].startswith('retention')]) > 0
-        
-        if required_by_date or retention_tag_found:
-            logging.info('%s: %s:%s keeping: %s' % (policy, aws_region, instance_id, ami[u'Name']))
-        else:
-            logging.info('%s: %s:%s deleting: %s' % (policy, aws_region, instance_id, ami[u'Name']))
-            
-            #List out the AMIs associated snapshots so we can remove those once the AMI is deregistered.
-            snapshots_to_delete = []
-            for block in ami[u'BlockDeviceMappings']:
-                snapshots_to_delete.append(block[u'Ebs'][u'SnapshotId'])
-             
-            try:
-                response = ec2_client.deregister_image(DryRun=dry_run,ImageId=ami[u'ImageId'])
-                logging.warning('%s: %s:%s deleted: %s - %s' % (policy, aws_region, instance_id, ami[u'Name'], response))
-            except botocore.exceptions.ClientError as e:
-                logging.error(e)
-            
-            for snapshot in snapshots_to_delete:
-                try:
-                    response = ec2_client.delete_snapshot(DryRun=dry_run,SnapshotId=snapshot)
-                    logging.warning('%s: %s:%s deleted: %s - %s' % (policy, aws_region, instance_id, snapshot, response))
-                except botocore.exceptions.ClientError as e:
-                    logging.error(e)
+    # All existing AMIs of the instance come from the region inventory. Failed AMIs are removed, those still pending
+    # are left alone, and only the available ones count toward retention.
+    key = state_key(aws_region, instance_id, account)
+    history = inventory.images_by_instance.get(instance_id, BackupHistory())
+    confirmed, failed = classify_backups(policy, key, history, inventory)
+    intent = {'aws_region': aws_region, 'account': account, 'policy': policy, 'asset': instance_id, 'key': key, 'retention': False}
+    for index in failed:
+        deletion_stage.put(dict(intent, kind='image', id=history.ids[index], snapshots=list(history.snapshots[index])))
+
+    # Nothing to decide if these were all evaluated earlier today under the same rules, though copies left for later
+    # may still be due.
+    backups = dict((history.ids[index], int(history.created[index])) for index in confirmed)
+    today = time.strftime('%Y-%m-%d', time.gmtime(run_started))
+    rules = {'retention_limits': retention_limits, 'dr_region': dr_region}
+    if backups_changed(policy, key, backups, rules, today):
+        started = time.time()
+        kept, deleted = apply_retention('image', history, confirmed, retention_limits, intent)
+        record_decision(key, backups, kept, deleted, rules, today)
+        metrics.add_phase('retention', time.time() - started)
+    else:
+        kept = state_store.asset(key).get('kept', [])
+    if dr_region is not None or state_store.asset(key).get('replicas'):
+        replicate('image', key, backups, kept, retention_limits, dr_region, intent)
     
 
     
 # process_volume
 #
 # Actions to complete:
-#   Take snapshot now
 #   Find existing snapshots
-#   Remove those not required by policy
+#   Remove those not required by policy, counting only those which are completed
 #
-@threaded
-def process_volume_id(policy='Unknown', aws_region=None, volume_id=None, retention_limits=None, ec2_client=None): 
+@pooled
+def process_volume_id(policy='Unknown', aws_region=None, volume_id=None, retention_limits=None, ec2_client=None, account=None, dr_region=None): 
     if aws_region is None or volume_id is None:
-        logging.error('%s: Could not process volume for %s-%s' % (policy, aws_region, volume_id))
+        logging.error('%s: Could not process volume for %s-%s', policy, aws_region, volume_id)
         return False
     if ec2_client is None:
-        ec2_client = boto3.client('ec2', region_name=aws_region)
+        ec2_client = get_client('ec2', aws_region, role_arn=account)
     
-    logging.info('%s: Processing Volume of %s (%s)' % (policy, volume_id, aws_region))
+    logging.info('%s: Processing Volume of %s (%s)', policy, volume_id, aws_region)
     
-    # Make sure the volume actually exists and collect data to name the snapshot.
-    try: 
-        response = ec2_client.describe_volumes(DryRun=False, VolumeIds=[volume_id])
-        volume_data = response[u'Volumes'][0]
-    except botocore.exceptions.ClientError as e:
-        logging.error('%s: %s - %s' % (policy, volume_id, e))
+    # Make sure the volume actually exists.
+    inventory = get_inventory(aws_region, ec2_client, account)
+    if volume_id not in inventory.volumes:
+        logging.error('%s: %s:%s could not be found', policy, aws_region, volume_id)
         return False
     
-    # Build a sensible description
-    if len(volume_data[u'Attachments']) > 0:
-        attachment = volume_data[u'Attachments'][0]
-        attachment_description = "Attached to %s:%s" % (attachment[u'InstanceId'], attachment[u'InstanceId'])
-    else:
-        attachment_description = 'Not Attached'
-    description = 'Created by Photographer(%s) - %s' % (volume_id, attachment_description)
+    # All the snapshots for the current volume come from the region inventory. Failed snapshots are removed, those
+    # still pending are left alone, and only completed ones count toward retention.
+    key = state_key(aws_region, volume_id, account)
+    history = inventory.snapshots_by_volume.get(volume_id, BackupHistory())
+    confirmed, failed = classify_backups(policy, key, history, inventory)
+    intent = {'aws_region': aws_region, 'account': account, 'policy': policy, 'asset': volume_id, 'key': key, 'retention': False}
+    for index in failed:
+        deletion_stage.put(dict(intent, kind='snapshot', id=history.ids[index]))
 
-    # Take the snapshot and tag it appropriately
-    try: 
-        response = ec2_client.create_snapshot(DryRun=dry_run, VolumeId=volume_id, Description=description)
-        snapshot_id = response[u'SnapshotId']
-        ec2_client.create_tags(DryRun=False, Resources=[snapshot_id], Tags=volume_data[u'Tags'])
-    except botocore.exceptions.ClientError as e:
-        logging.error('%s: %s - %s' % (policy, volume_id, e))
-        return False  
-    
-    # Find all the snapshots for the current volume
-    response = ec2_client.describe_snapshots(OwnerIds=['self'],Filters=[{'Name':'volume-id','Values':[volume_id]}])
-    #Filter for only those created by photograpgher
-    existing_snapshots = [ss for ss in response[u'Snapshots'] if ss[u'Description'].startswith('Created by Photographer')]
-    # Build to a list of datetimes
-    snapshot_dates = [ss[u'StartTime'] for ss in existing_snapshots]
-    # Calculate which datetimes are required to be retained under the retention policy
-    retained_dates = dates_to_keep(retention_limits=retention_limits, dates=snapshot_dates)
-
-    # Now check each Snapshot in turn cleaning up those which are not needed
-    for snapshot in existing_snapshots:
-        # Check if this AMIs date is in the list we want to keep, if not remove it.
-        # It must either be the list of dates required by policy or tagged with a retention tag
-        required_by_date = snapshot[u'StartTime'] in retained_dates
-        retention_tag_found = len([tag for tag in snapshot.get(u'Tags',[]) if tag[u'Key'].startswith('retention')]) > 0
-        
-        if required_by_date or retention_tag_found:
-            logging.info('%s: %s:%s keeping %s (Date=%s, Tag=%s)' % (policy, aws_region, volume_id, snapshot[u'Description'], required_by_date, retention_tag_found))
-        else:
-            logging.info('%s: %s:%s deleting: %s' % (policy, aws_region, volume_id, snapshot[u'Description']))
-            
-            try:
-                response = ec2_client.delete_snapshot(DryRun=dry_run,SnapshotId=snapshot[u'SnapshotId'])
-                logging.warning('%s: %s:%s deleted: %s - %s' % (policy, aws_region, volume_id, snapshot, response))
-            except botocore.exceptions.ClientError as e:
-                logging.error(e)
+    # Nothing to decide if these were all evaluated earlier today under the same rules, though copies left for later
+    # may still be due.
+    backups = dict((history.ids[index], int(history.created[index])) for index in confirmed)
+    today = time.strftime('%Y-%m-%d', time.gmtime(run_started))
+    rules = {'retention_limits': retention_limits, 'dr_region': dr_region}
+    if backups_changed(policy, key, backups, rules, today):
+        started = time.time()
+        kept, deleted = apply_retention('snapshot', history, confirmed, retention_limits, intent)
+        record_decision(key, backups, kept, deleted, rules, today)
+        metrics.add_phase('retention', time.time() - started)
+    else:
+        kept = state_store.asset(key).get('kept', [])
+    if dr_region is not None or state_store.asset(key).get('replicas'):
+        replicate('snapshot', key, backups, kept, retention_limits, dr_region, intent)
 
 
 # process_policy
 #
-# A threaded function to allow all policies to be processed in parallel.
-@threaded 
-def process_policy(policy = None, cp=None):
+# Run through the worker pool to allow all policies to be processed in parallel, once for each of their accounts.
+# Returns the assets the policy covers in the account as a list of (process function, arguments) for dispatch_assets.
+@pooled
+def process_policy(policy=None, account=None):
+    name = '%s@%s' % (policy.name, account_id(account)) if account else policy.name
+    logging.info('%s is operating in %s.', name, policy.aws_region)
+    ec2_client = get_client('ec2', policy.aws_region, role_arn=account)
+    retention_limits = policy.limits()
+    inventory = None
+    if policy.instance_names or policy.volume_selector or policy.instance_selector:
+        inventory = get_inventory(policy.aws_region, ec2_client, account)
+
+    #Find all assets to be backed up
+    assets = []
+    #Volumes first, those listed and those matching the selector
+    volume_ids = list(policy.volume_ids)
+    if policy.volume_selector:
+        matched = [volume_id for volume_id, volume in inventory.volumes.items() if selector_matches(policy.volume_selector, volume, inventory)]
+        logging.info('%s: volume_selector matched %s volumes.', name, len(matched))
+        volume_ids.extend(matched)
+
+    for volume_id in set(volume_ids):
+        assets.append((process_volume_id, dict(policy=name, aws_region=policy.aws_region, volume_id=volume_id, retention_limits=retention_limits, ec2_client=ec2_client, account=account, dr_region=policy.dr_region)))
+
+    #Instances, those specified by name are converted to InstanceIDs
+    instance_ids = list(policy.instance_ids)
+    for instance_name in policy.instance_names:
+        for instance in inventory.instances_by_name.get(instance_name, []):
+            logging.info('%s: Found instance %s with name %s.', name, instance[u'InstanceId'], instance_name)
+            instance_ids.append(instance[u'InstanceId'])
+
+    if policy.instance_selector:
+        matched = [instance_id for instance_id, instance in inventory.instances.items()
+                   if instance.get(u'State', {}).get(u'Name') not in ('shutting-down', 'terminated')
+                   and selector_matches(policy.instance_selector, instance, inventory)]
+        logging.info('%s: instance_selector matched %s instances.', name, len(matched))
+        instance_ids.extend(matched)
+
+    instance_ids = list(set(instance_ids))
+    for instance_id in instance_ids:
+        assets.append((process_instance_id, dict(policy=name, aws_region=policy.aws_region, instance_id=instance_id, retention_limits=retention_limits, ec2_client=ec2_client, account=account, dr_region=policy.dr_region)))
+    return assets
+
+
+
+# asset_key
+#
+# The key an asset's state is stored under, see state_key, from the arguments of its process function.
+def asset_key(kwargs):
+    return state_key(kwargs['aws_region'], kwargs.get('volume_id') or kwargs.get('instance_id'), kwargs.get('account'))
+
+
+
+# The function taking the backup of each kind of asset, see create_backups.
+backup_functions = {process_instance_id: backup_instance_id, process_volume_id: backup_volume_id}
+
+
+
+# create_backups
+#
+# Take a backup of each asset given, in the order given, before any retention work starts. Creations are submitted
+# to the worker pool as fast as it takes them, so backups start as close together in time as the pool allows.
+# Nothing waits for a backup to complete: its id is recorded as pending and it only counts toward retention once a
+# later run finds it completed, see classify_backups. Once the deadline passes no more backups are started.
+#
+# Returns the keys of the assets not backed up, for the backup cursor, see save_cursor.
+def create_backups(assets, deadline=None):
+    with metrics.phase('backup'):
+        for position, (fn, kwargs) in enumerate(assets):
+            while not worker_pool.wait_for_capacity(max_workers, 1):
+                pass
+            if deadline is not None and time.time() > deadline:
+                logging.warning('Time budget reached, %s of %s backups left for the next invocation.', len(assets) - position, len(assets))
+                worker_pool.wait()
+                return [asset_key(kwargs) for fn, kwargs in assets[position:]]
+            backup_functions[fn](**kwargs)
+        worker_pool.wait()
+    return []
+
+
+
+# merge_assets
+#
+# Combine the assets found by all policies so one selected by several is backed up once. It takes the largest of
+# each retention limit across those policies, keeping every backup any one of them would keep, and the first
+# dr_region any of them names.
+def merge_assets(assets):
+    merged = collections.OrderedDict()
+    for fn, kwargs in assets:
+        key = asset_key(kwargs)
+        if key not in merged:
+            merged[key] = (fn, dict(kwargs))
+            continue
+        existing = merged[key][1]
+        logging.info('%s is selected by %s and %s, using the stricter retention.', key, existing['policy'], kwargs['policy'])
+        existing['policy'] = '%s+%s' % (existing['policy'], kwargs['policy'])
+        existing['retention_limits'] = dict((limit, max(value, kwargs['retention_limits'][limit]))
+                                            for limit, value in existing['retention_limits'].items())
+        existing['dr_region'] = existing.get('dr_region') or kwargs.get('dr_region')
+    return merged.values()
+
+
+
+# order_assets
+#
+# Sort assets with those left over from an earlier invocation, held in the state as the named cursor, first and in
+# the cursor's order, followed by the rest in order of staleness(key), stalest first. An invocation handling events
+# does not resume from the cursors.
+def order_assets(assets, cursor, staleness, resume=True):
+    positions = dict((key, position) for position, key in enumerate(state_store.get(cursor, []))) if resume else {}
+
+    def order(asset):
+        key = asset_key(asset[1])
+        return (key not in positions, positions.get(key, 0), staleness(key))
+    return sorted(assets, key=order)
+
+
+
+# last_backup
+#
+# When an asset was last backed up, confirmed or still pending, in epoch seconds. Orders assets for create_backups.
+def last_backup(key):
+    asset = state_store.asset(key)
+    return max([asset.get('last_success', 0)] + asset.get('pending', {}).values())
+
+
+
+# last_decision
+#
+# The day retention was last decided for an asset. Orders assets for dispatch_assets.
+def last_decision(key):
+    return state_store.asset(key).get('decided', '')
+
+
+
+# save_cursor
+#
+# Store the keys of the assets an invocation did not reach as the named cursor, for the next invocation to start
+# with. An invocation handling events, which did not resume from the cursor, adds to it rather than replacing it.
+def save_cursor(cursor, keys, resume=True):
+    if not resume:
+        previous = state_store.get(cursor, [])
+        keys = previous + [key for key in keys if key not in set(previous)]
+    state_store.set(cursor, keys)
+
+
+
+# dispatch_assets
+#
+# Submit the assets, in order, to the worker pool, keeping no more than max_workers in flight. Once the deadline
+# passes nothing more is dispatched.
+#
+# Returns a list of (asset key, Job) for the assets dispatched and the keys of those not reached.
+def dispatch_assets(assets, deadline=None):
+    dispatched = []
+    for position, (fn, kwargs) in enumerate(assets):
+        while not worker_pool.wait_for_capacity(max_workers, 1):
+            pass
+        if deadline is not None and time.time() > deadline:
+            remaining = [asset_key(kwargs) for fn, kwargs in assets[position:]]
+            logging.warning('Time budget reached, %s of %s assets left for the next invocation.', len(remaining), len(assets))
+            return dispatched, remaining
+        dispatched.append((asset_key(kwargs), fn(**kwargs)))
+    return dispatched, []
+
+
+
+# event_assets
+#
+# The assets named by a single EventBridge event, as (account id, region, kind, id, action). kind is 'volumes',
+# 'instances' or 'images' (an image stands for the instance it was taken of) and action is what the event asks for:
+#   retention - a backup completed or failed (EBS Snapshot Notification, EC2 AMI State Change)
+#   selected  - the asset's tags changed, so it may now be selected by a policy (Tag Change on Resource)
+#   backup    - a backup is due (Photographer Backup, a custom event with detail {"asset_id", "aws_region", "account"}
+#               sent by EventBridge Scheduler or put_events)
+# Returns None for the scheduled event of the periodic run, which scans everything.
+def event_assets(event):
+    detail = event.get('detail') or {}
+    account, aws_region = event.get('account'), event.get('region')
+    detail_type = event.get('detail-type')
+
+    if detail_type == 'Scheduled Event':
+        return None
+    if detail_type == 'EBS Snapshot Notification' and detail.get('event') in ('createSnapshot', 'createSnapshots'):
+        sources = [detail.get('source')] + [snapshot.get('source') for snapshot in detail.get('snapshots', [])]
+        return [(account, aws_region, 'volumes', source.split('/')[-1], 'retention') for source in sources if source]
+    if detail_type == 'EC2 AMI State Change' and detail.get('State') in ('available', 'failed'):
+        return [(account, aws_region, 'images', detail['ImageId'], 'retention')]
+    if detail_type == 'Tag Change on Resource' and detail.get('service') == 'ec2' and detail.get('resource-type') in ('instance', 'volume'):
+        return [(account, aws_region, detail['resource-type'] + 's', arn.split('/')[-1], 'selected') for arn in event.get('resources', [])]
+    if detail_type == 'Photographer Backup' and detail.get('asset_id', '').startswith(('vol-', 'i-')):
+        kind = 'volumes' if detail['asset_id'].startswith('vol-') else 'instances'
+        return [(detail.get('account', account), detail.get('aws_region', aws_region), kind, detail['asset_id'], 'backup')]
+    logging.warning('Ignoring %s event %s.', detail_type, event.get('id'))
+    return []
+
+
+
+# event_targets
+#
+# Group the assets named by an EventBridge event, or by the batch of them in the Records of an SQS event, by account
+# and region. Each (account role or None, region) maps to a scope for RegionInventory: the ids of its volumes,
+# instances and images and, under 'backup' and 'selected', the asset ids each of those actions was asked for.
+# Events from accounts other than those in account_roles are taken to be from the Lambda's own account.
+#
+# Returns None when there are no events, or one of them is the periodic run's, for a full scan of every policy.
+def event_targets(event):
+    if not event:
+        return None
+    events = [json.loads(record['body']) for record in event['Records']] if 'Records' in event else [event]
+    roles = dict((account_id(role_arn), role_arn) for role_arn in account_roles)
+    targets = {}
+    for item in events:
+        assets = event_assets(item)
+        if assets is None:
+            return None
+        for account, aws_region, kind, asset_id, action in assets:
+            scope = targets.setdefault((roles.get(account), aws_region), {'volumes': set(), 'instances': set(), 'images': set(),
+                                                                          'backup': set(), 'selected': set()})
+            scope[kind].add(asset_id)
+            if action != 'retention':
+                scope[action].add(asset_id)
+    metrics.count('Events', len(events))
+    logging.info('Handling %s events for %s assets in %s regions.', len(events),
+                 sum(len(scope['volumes']) + len(scope['instances']) + len(scope['images']) for scope in targets.values()), len(targets))
+    return targets
+
+
+
+# load_scoped_inventory
+#
+# Load the inventory of just the assets in the scope of an account and region, see event_targets.
+def load_scoped_inventory(aws_region, account, scope):
+    inventories[(account, aws_region)] = RegionInventory(aws_region, get_client('ec2', aws_region, role_arn=account), scope)
+
+
+
+# event_backup_wanted
+#
+# Whether an asset named by events should be backed up now: a backup was asked for, or its tags changed and it has
+# no state yet, so it has only just been selected by a policy.
+def event_backup_wanted(scope, kwargs):
+    asset_id = kwargs.get('volume_id') or kwargs.get('instance_id')
+    return asset_id in scope['backup'] or (asset_id in scope['selected'] and not state_store.asset(asset_key(kwargs)))
+
 
-            #Get Region
-            try:
-                aws_region = cp.get(policy, 'aws_region')
-                logging.info('%s is operating in %s.' % (policy, aws_region))
-            except ConfigParser.NoOptionError as e:
-                logging.error('%s does not specify a region, this is required ignoring policy.' % policy)
-                return False
-            
-            aws_regions = ['us-east-1', 'us-west-2', 'us-west-1', 
-               'eu-west-1', 'eu-central-1', 'ap-southeast-1', 
-               'ap-southeast-2', 'ap-northeast-1', 'sa-east-1']            
-            if aws_region not in aws_regions:
-                logging.error('%s specified an invalid region (%s), this is required ignoring policy.' % (policy, aws_region))
-                return False   
-            ec2_client = boto3.client('ec2', region_name=aws_region)
-        
-            retention_limits = {'most_recent':5, 'days':7, 'weeks':4, 'months':2 }
-    
-            #Get retention limits
-            for limit in retention_limits:
-                try:
-                    retention_limits[limit] = cp.getint(policy, limit)
-                except ConfigParser.NoOptionError as e:
-                    logging.warning('%s does not declare %s number, assuming default of %s.' % (policy, limit, retention_limits[limit]))
-
-            #Find all assets to be backed up
-            #Volumes first
-            try:
-                volume_ids = cp.get(policy, 'volume_ids')
-                if volume_ids == 'None':
-                    volume_ids = []
-                else:
-                    volume_ids = volume_ids.split()
-            except ConfigParser.NoOptionError as e:
-                logging.info('%s has not declared a volume section.' % policy)
-                
-            for volume_id in volume_ids:
-                process_volume_id(policy=policy, aws_region=aws_region, volume_id=volume_id, retention_limits=retention_limits, ec2_client=ec2_client)
-
-            #Instances
-            instance_ids = []
-            #First take all instances specified by name and convert to InstanceIDs
-            try:
-                instances_by_name = cp.get(policy, 'instance_names')
-                if instances_by_name == 'None':
-                    instances_by_name = []
-                else:
-                    instances_by_name = instances_by_name.split()
-                
-                response = ec2_client.describe_instances(Filters=[{'Name':'tag:Name','Values':instances_by_name}])
-                for reservation in response[u'Reservations']:
-                    for instance in reservation[u'Instances']:
-                        name = [tag for tag in instance[u'Tags'] if tag['Key'] == 'Name'][0]['Value']
-                        logging.info('%s: Found instance %s with name %s.' % (policy, instance[u'InstanceId'], name))
-                        instance_ids.append(instance[u'InstanceId'])
-            except ConfigParser.NoOptionError as e:
-                logging.info('%s has not declared any instances by name.' % policy)            
 
-            try:
-                instances_by_id = cp.get(policy, 'instance_ids')
-                if instances_by_id == 'None':
-                    instances_by_id = []
-                else: 
-                    instance_ids.extend(instances_by_id.split())
-            except ConfigParser.NoOptionError as e:
-                logging.info('%s has not declared any instance by id.' % policy)
-                
-            instance_ids = list(set(instance_ids))
-            for instance_id in instance_ids:
-                process_instance_id(policy=policy, aws_region=aws_region, instance_id=instance_id, retention_limits=retention_limits, ec2_client=ec2_client)
-
-                
 # lambda_handler
 #
 # Function to be provided to lambda configuration, if this file is uploaded as a ZIP file, use photographer.lambda_handler as the function name
 def lambda_handler(event, context):
+    global worker_pool, state_store, deletion_stage, replication_stage, run_started
 
+    run_started = time.time()
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging_level)  
+    client_stats.update(created=0, reused=0)
+    metrics.reset()
 
     #load configu file from S3
-    cp = load_config(s3_bucket, s3_file)
-    #cp = ConfigParser.ConfigParser()
-    #cp.read('../config_examples/photographer.conf')
+    with metrics.phase('config'):
+        policies, rejected = load_config(s3_bucket, s3_file)
 
-    for section in cp.sections():
-        try:
-            process_policy(policy = section, cp=cp)
-        except Exception as e:
-            logging.error('An uncaught exception was thrown passing %s (%s)' % (section, e))
-            
-    while threading.active_count() > 1:
-        logging.debug('Currently active threads: %s' % threading.active_count() )
-        time.sleep(0.1)
+    # Work out when to stop starting new work, if running in Lambda.
+    deadline = None
+    deletion_deadline = time.time() + deletion_time_budget
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+        deadline = time.time() + remaining - time_safety_margin
+        deletion_deadline = min(deletion_deadline, time.time() + remaining - time_safety_margin / 2.0)
+
+    state_store = StateStore(s3_bucket, s3_state_file).load()
+    worker_pool = WorkerPool()
+    inventories.clear()
+
+    # Deletions left over from the last run go first, other than those retention decided (or checkpointed without
+    # saying), whose assets are processed first and delete whatever their decision now leaves.
+    deletion_stage = DeletionStage(deletion_deadline)
+    for intent in state_store.get('pending_deletions', []):
+        if intent.get('retention', True) is False:
+            deletion_stage.put(intent)
+
+    # Copies to the DR regions started by earlier runs are confirmed before any asset is processed.
+    replication_stage = ReplicationStage(deletion_deadline)
+    with metrics.phase('replication'):
+        replication_stage.confirm()
+
+    # Given events, only the assets they name are described and processed, by the same policies.
+    targets = event_targets(event)
+    if targets is not None:
+        covered = set((account, policy.aws_region) for policy in policies for account in policy.accounts)
+        targets = dict((key, scope) for key, scope in targets.items() if key in covered)
+        for (account, aws_region), scope in targets.items():
+            worker_pool.submit('inventory(%s)' % state_key(aws_region, 'events', account), None, load_scoped_inventory, (aws_region, account, scope))
+        worker_pool.wait()
+        targets = dict((key, scope) for key, scope in targets.items() if key in inventories)
+
+    policies = [process_policy(policy=policy, account=account) for policy in policies for account in policy.accounts
+                if targets is None or (account, policy.aws_region) in targets]
+    worker_pool.wait()
+
+    assets = []
+    for job in policies:
+        if job.succeeded():
+            assets.extend(job.result)
+    # Backups within their share of the time budget, then retention within the rest. Each resumes from its own cursor,
+    # so assets backed up but not yet processed are processed first by the next run without being backed up again.
+    backup_deadline = None if deadline is None else run_started + (deadline - run_started) * backup_time_share
+    resume = targets is None
+    if resume:
+        assets = merge_assets(assets)
+        uncreated = create_backups(order_assets(assets, 'cursor', last_backup), backup_deadline)
+    else:
+        # Policies listing assets by id find more than the events name, only those the events are about are processed.
+        assets = merge_assets([(fn, kwargs) for fn, kwargs in assets
+                               if (kwargs.get('volume_id') or kwargs.get('instance_id')) in inventories[(kwargs.get('account'), kwargs['aws_region'])].targets])
+        uncreated = create_backups(order_assets([(fn, kwargs) for fn, kwargs in assets if event_backup_wanted(targets[(kwargs.get('account'), kwargs['aws_region'])], kwargs)],
+                                                'cursor', last_backup, resume), backup_deadline)
+    dispatched, unprocessed = dispatch_assets(order_assets(assets, 'retention_cursor', last_decision, resume), deadline)
+
+    # Wait for every asset to finish, then for the copies and deletions they queued.
+    worker_pool.join()
+    if resume and all(job.succeeded() for job in policies):
+        prune_state(set(asset_key(kwargs) for fn, kwargs in assets), int(run_started))
+    copies = replication_stage.finish()
+    deletions = deletion_stage.finish()
+    state_store.set('pending_deletions', [intent for intent in deletion_stage.deferred if not intent.get('retention')])
+    undeleted = [intent['key'] for intent in deletion_stage.deferred if intent.get('retention')]
+    save_cursor('cursor', uncreated, resume)
+    save_cursor('retention_cursor', list(collections.OrderedDict.fromkeys(undeleted + unprocessed)), resume)
+    # A dry run deletes and creates nothing, so the decisions, pending deletions and cursors it recorded are not saved.
+    if dry_run:
+        logging.info('Dry run, the state file is left unchanged.')
+    else:
+        state_store.save()
+    logging.info('Clients created: %s, client constructions saved by reuse: %s', client_stats['created'], client_stats['reused'])
+    summary = worker_pool.summary()
+    summary['deletions'] = deletions
+    summary['copies'] = copies
+    summary['rejected'] = rejected
+    summary['mode'] = 'scan' if targets is None else 'events'
+    metrics.emit(Succeeded=len(summary['succeeded']), Failed=len(summary['failed']), Rejected=len(rejected), DeferredDeletions=deletions['deferred'],
+                 CopiesStarted=copies['copied'], DeferredCopies=copies['deferred'],
+                 ClientsCreated=client_stats['created'], ClientsReused=client_stats['reused'])
+    return summary
     
 if __name__ == '__main__':
     lambda_handler(None, None)
\ No newline at end of file
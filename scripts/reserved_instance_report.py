@@ -16,13 +16,22 @@
 #
 #    This lambda script has the following configuration requirements:
 #    * Run with a IAM role that has the following permissions
-#      * Describe all Reserved Instances in all regions specified
-#      * Send email using SES
+#      * Describe the regions enabled, and all Reserved Instances and instances in them
+#      * Assume the roles in account_roles, each allowing the same in its account
+#      * Send email using SES, including raw email if attach_large_report is set
+#      * Put objects in report_bucket, if set
+#      * List, get and put objects under history_prefix in history_bucket, if set
 #    * Scheduled to run periodically (it will not react to the event info supplied)
 #    * Timeout should be increased to 30s (its time to run is dependent on number of reserved instances)
 #
 #    Customisation
-#    * regions - remove any regions you don't required
+#    * regions - the regions to report on, None for every region enabled in each account (see RegionRegistry)
+#    * region_cache_ttl - seconds the enabled regions of each account are remembered across warm invocations
+#    * empty_region_days / empty_region_recheck_days - a region which has had no reservations or running instances
+#      for empty_region_days is only queried again every empty_region_recheck_days
+#    * account_roles - roles in other accounts to include in the report, which is then one report across all of them
+#    * max_threads - how many account/region queries to run at once
+#    * region_timeout - seconds to wait for the regions, which are queried in parallel, before reporting them as failed
 #    * tags_of_interest - any tags that you would like to appear in the report
 #    * red_warning_days - days left to trigger red warning (default 30)
 #    * orange_warning_days - days left to trigger orange warning (default 60)
@@ -30,40 +39,729 @@
 #    * subject_string - email subject
 #    * from_address - address from which report is sent
 #    * to_address - address to which report is sent
+#    * max_email_bytes - size of the text and HTML report above which a summary is emailed instead (SES limit is 10MB)
+#    * report_bucket - S3 bucket the full report is uploaded to, gzipped CSV, when it is too large to email
+#    * report_prefix - prefix of the uploaded reports' keys, which are followed by the date
+#    * attach_large_report - attach the gzipped CSV to the summary email, when it fits
+#    * history_bucket / history_dir - S3 bucket or local directory keeping a snapshot of the reservations from each
+#      run, which the report is compared with to show what has changed since the last one (None for no history)
+#    * history_prefix - prefix of the snapshots' keys in history_bucket
+#    * history_weeks - number of snapshots, the latest included, shown in the trend table
 
 import json
-import boto3
-import smtplib
+import os
+import zlib
+import importlib
+import bisect
+import calendar
+import csv
 import datetime
-from dateutil.tz import tzlocal
+import gzip
+import StringIO
+import threading
+import time
+import Queue
 
 print('Loading function')
 
-def list_to_html_table(list):
-    header = list[0]
-    body = list[1:]
-    
-    #add header
-    html = "<table><tr><th>%s</th></tr>" % ("</th><th>".join(header))
-    
-    for row in body:
-        html += "<tr>"
-        html += "<th>%s</th>" % row[0]
-        for col in row[1:]:
-            html += "<td>%s</td>" % col
-        html += "</tr>"
-    html += "</table>"
-    return html
- 
+# Stands in for a module which is only imported once one of its attributes is first used, so boto3, botocore and
+# dateutil are not loaded during a cold start until the report needs them. Submodules, such as botocore.config, are
+# imported on first use in the same way.
+class LazyModule(object):
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        try:
+            return getattr(self._module, attr)
+        except AttributeError:
+            return importlib.import_module('%s.%s' % (self._name, attr))
+
+boto3 = LazyModule('boto3')
+botocore = LazyModule('botocore')
+tz = LazyModule('dateutil.tz')
+
+# Metrics
+#
+# Per invocation instrumentation. Hooked into botocore's events on every client, it counts the calls, retries,
+# throttles and errors of each region and operation and keeps a histogram of their latency. phase() times a named
+# stage of the run, summing across threads when the stage runs in parallel. emit() prints everything, along with any
+# counts passed to it, as a single CloudWatch embedded metric format (EMF) line. CloudWatch Logs turns the totals
+# into metrics while the per operation breakdown stays queryable with Logs Insights.
+class Metrics(object):
+    latency_buckets = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+    throttling_errors = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'SlowDown')
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+            self.phases = {}
+            self.started = time.time()
+
+    def register(self, client):
+        client.meta.events.register('before-call', self.before_call)
+        client.meta.events.register('after-call', self.after_call)
+        client.meta.events.register('needs-retry', self.needs_retry)
+
+    def _operation(self, region, operation):
+        key = '%s:%s' % (region, operation)
+        if key not in self.operations:
+            self.operations[key] = {'calls': 0, 'retries': 0, 'throttles': 0, 'errors': 0,
+                                    'latency_ms': [0] * (len(self.latency_buckets) + 1)}
+        return self.operations[key]
+
+    def before_call(self, context=None, **kwargs):
+        if context is not None:
+            context['metrics_started'] = time.time()
+
+    def after_call(self, http_response=None, parsed=None, model=None, context=None, event_name=None, **kwargs):
+        latency = (time.time() - context.get('metrics_started', time.time())) * 1000 if context is not None else 0
+        region = context.get('client_region') if context is not None else None
+        with self.lock:
+            stats = self._operation(region, model.name if model is not None else event_name)
+            stats['calls'] += 1
+            stats['retries'] += (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            if http_response is not None and http_response.status_code >= 300:
+                stats['errors'] += 1
+            stats['latency_ms'][bisect.bisect_left(self.latency_buckets, latency)] += 1
+
+    def needs_retry(self, response=None, operation=None, request_dict=None, **kwargs):
+        if response is None:
+            return None
+        code = (response[1] or {}).get('Error', {}).get('Code')
+        if code in self.throttling_errors:
+            region = (request_dict or {}).get('context', {}).get('client_region')
+            with self.lock:
+                self._operation(region, operation.name if operation is not None else None)['throttles'] += 1
+        return None
+
+    def phase(self, name):
+        return MetricsPhase(self, name)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def emit(self, **properties):
+        with self.lock:
+            totals = dict((field, sum(stats[field] for stats in self.operations.values())) for field in ('calls', 'retries', 'throttles', 'errors'))
+            values = {'ApiCalls': totals['calls'], 'Retries': totals['retries'], 'Throttles': totals['throttles'],
+                      'Errors': totals['errors'], 'Duration': round(time.time() - self.started, 3)}
+            for name, seconds in self.phases.items():
+                values['Phase %s' % name] = round(seconds, 3)
+            values.update(properties)
+            record = {'_aws': {'Timestamp': int(time.time() * 1000),
+                               'CloudWatchMetrics': [{'Namespace': self.namespace, 'Dimensions': [[]],
+                                                      'Metrics': [{'Name': name, 'Unit': 'Seconds' if name == 'Duration' or name.startswith('Phase ') else 'Count'}
+                                                                  for name in sorted(values)]}]},
+                      'operations': self.operations,
+                      'latency_buckets_ms': self.latency_buckets}
+            record.update(values)
+        print json.dumps(record, sort_keys=True, default=str)
+        return record
+
+
+
+# MetricsPhase
+#
+# Context manager returned by Metrics.phase, adding the time spent inside it to the named phase.
+class MetricsPhase(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_phase(self.name, time.time() - self.started)
+        return False
+
+metrics = Metrics('ReservedInstanceReport')
+
+# Clients are cached at module level so warm invocations reuse them rather than paying for construction each run.
+clients = {}
+client_lock = threading.Lock()
+client_stats = {'created': 0, 'reused': 0}
+
+# Credentials of the roles assumed in other accounts, also kept across warm invocations. They are assumed again, and
+# the clients using them dropped, once within credential_refresh_margin seconds (or half their lifetime) of expiry.
+credentials = {}
+credential_lock = threading.Lock()
+credential_refresh_margin = 900
+
+def get_client(service, region, role_arn=None):
+    key = (service, region, role_arn)
+    role_credentials = assumed_credentials(role_arn) if role_arn else {}
+    with client_lock:
+        if key in clients:
+            client_stats['reused'] += 1
+        else:
+            config = botocore.config.Config(max_pool_connections=10, retries={'mode': 'adaptive', 'max_attempts': 10})
+            clients[key] = boto3.client(service, region_name=region, config=config,
+                                        aws_access_key_id=role_credentials.get('AccessKeyId'),
+                                        aws_secret_access_key=role_credentials.get('SecretAccessKey'),
+                                        aws_session_token=role_credentials.get('SessionToken'))
+            metrics.register(clients[key])
+            client_stats['created'] += 1
+        return clients[key]
+
+def assumed_credentials(role_arn):
+    with credential_lock:
+        cached = credentials.get(role_arn)
+        if cached is None or time.time() >= cached['Refresh']:
+            response = get_client('sts', None).assume_role(RoleArn=role_arn, RoleSessionName='reserved_instance_report')['Credentials']
+            expiration = calendar.timegm(response['Expiration'].utctimetuple())
+            cached = {'AccessKeyId': response['AccessKeyId'], 'SecretAccessKey': response['SecretAccessKey'],
+                      'SessionToken': response['SessionToken'],
+                      'Refresh': expiration - min(credential_refresh_margin, (expiration - time.time()) / 2)}
+            credentials[role_arn] = cached
+            with client_lock:
+                for key in [key for key in clients if key[2] == role_arn]:
+                    del clients[key]
+        return cached
+
+# The label of an account in the report, the account id of its role or 'local' for the Lambda's own account.
+def account_label(role_arn):
+    return role_arn.split(':')[4] if role_arn else 'local'
+
+# A MIME message with text and HTML alternatives and the given (filename, data) attachments, for send_raw_email.
+# Only reports too large to email need one, so the email package is not imported until then.
+def raw_email(from_address, to_address, subject, text, html, attachments):
+    from email.mime.application import MIMEApplication
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    message = MIMEMultipart('mixed')
+    message['Subject'] = subject
+    message['From'] = from_address
+    message['To'] = to_address
+    body = MIMEMultipart('alternative')
+    body.attach(MIMEText(text, 'plain', 'utf-8'))
+    body.attach(MIMEText(html, 'html', 'utf-8'))
+    message.attach(body)
+    for filename, data in attachments:
+        attachment = MIMEApplication(data, 'gzip')
+        attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+        message.attach(attachment)
+    return message.as_string()
+
+def html_table_row(row):
+    return "<tr><th>%s</th>%s</tr>" % (row[0], "".join(["<td>%s</td>" % col for col in row[1:]]))
+
+# The attributes a reservation and a running instance must share for the reservation to cover the instance: instance
+# type, platform and tenancy. Reservations describe their platform as a product, e.g. 'Linux/UNIX (Amazon VPC)',
+# which is reduced to the platform names instances report in PlatformDetails. Instances launched before
+# PlatformDetails existed only say whether they are Windows.
+def reservation_key(ri):
+    return (ri[u'InstanceType'], ri[u'ProductDescription'].replace(' (Amazon VPC)', ''), ri.get(u'InstanceTenancy', 'default'))
+
+def instance_key(instance):
+    platform = instance.get(u'PlatformDetails') or ('Windows' if instance.get(u'Platform') == 'windows' else 'Linux/UNIX')
+    return (instance[u'InstanceType'], platform, instance.get(u'Placement', {}).get(u'Tenancy', 'default'))
+
+# Count the running instances of a region by (instance_key, AZ). Only the counts are kept, so memory does not grow with
+# the size of the describe responses.
+def running_instances(ec2):
+    running = {}
+    paginator = ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=[{'Name': 'instance-state-name', 'Values': ['running']}], PaginationConfig={'PageSize': 1000}):
+        for reservation in page[u'Reservations']:
+            for instance in reservation[u'Instances']:
+                group = (instance_key(instance), instance[u'Placement'][u'AvailabilityZone'])
+                running[group] = running.get(group, 0) + 1
+    return running
+
+# Match the running instances of a region against its active reservations. Zonal reservations are applied first, to
+# instances of the same key in their AZ, then regional reservations to whatever is left of the same key in any AZ.
+# Both are found by dictionary lookup and each reservation is only visited until its capacity is used up, so the work
+# grows with the number of reservations and instance groups rather than their product. Returns the coverage of each
+# key as {key: [running, covered, reserved]} and the reservations with unused capacity as [(ri, unused)].
+def match_reservations(reservations, running, now):
+    zonal = {}
+    regional = {}
+    remaining = {}
+    coverage = {}
+    for ri in reservations:
+        if ri[u'State'] != 'active' or ri[u'End'] <= now:
+            continue
+        key = reservation_key(ri)
+        if ri.get(u'Scope') == 'Region':
+            regional.setdefault(key, []).append(ri)
+        else:
+            zonal.setdefault((key, ri[u'AvailabilityZone']), []).append(ri)
+        remaining[ri[u'ReservedInstancesId']] = ri[u'InstanceCount']
+        coverage.setdefault(key, [0, 0, 0])[2] += ri[u'InstanceCount']
+
+    def allocate(ris, count):
+        for ri in ris:
+            if not count:
+                break
+            used = min(count, remaining[ri[u'ReservedInstancesId']])
+            remaining[ri[u'ReservedInstancesId']] -= used
+            count -= used
+        return count
+
+    leftover = {}
+    for (key, zone), count in running.items():
+        coverage.setdefault(key, [0, 0, 0])[0] += count
+        leftover[key] = leftover.get(key, 0) + allocate(zonal.get((key, zone), ()), count)
+    for key, count in leftover.items():
+        coverage[key][1] = coverage[key][0] - allocate(regional.get(key, ()), count)
+
+    unused = []
+    for ris in zonal.values() + regional.values():
+        for ri in ris:
+            if remaining[ri[u'ReservedInstancesId']]:
+                unused.append((ri, remaining[ri[u'ReservedInstancesId']]))
+    return coverage, unused
+
+# Fetch the reservations and running instances of one region of an account and put
+# ((account, region), reservations, running, error) on the results queue.
+def fetch_region(account, region, results):
+    try:
+        ec2 = get_client('ec2', region, account)
+        reservations = ec2.describe_reserved_instances()['ReservedInstances']
+        results.put(((account, region), reservations, running_instances(ec2), None))
+    except Exception as e:
+        results.put(((account, region), None, None, e))
+
+# Worker thread draining (account, region) tasks, so no more than max_threads queries run at once.
+def fetch_regions(tasks, results):
+    while True:
+        try:
+            account, region = tasks.get_nowait()
+        except Queue.Empty:
+            return
+        fetch_region(account, region, results)
+
+# Discovers the regions enabled in each account with describe_regions, remembering them across warm invocations until
+# they are older than the ttl given, and records when each region of each account was last queried and last had
+# reservations or running instances. A region with nothing in it for empty_window seconds is only queried once recheck
+# seconds have passed since it last was, see due(), and regions which have had something most recently go first.
+# The records are kept in the SnapshotStore when there is one, otherwise only across warm invocations.
+class RegionRegistry(object):
+    def __init__(self):
+        self.discovered = {}
+        self.seen = {}
+
+    def regions(self, account, ttl):
+        cached = self.discovered.get(account)
+        if cached is None or time.time() - cached[0] >= ttl:
+            response = get_client('ec2', 'us-east-1', account).describe_regions()
+            cached = self.discovered[account] = (time.time(), sorted(region[u'RegionName'] for region in response[u'Regions']))
+        return cached[1]
+
+    def last_found(self, account, region):
+        return self.seen.get('%s:%s' % (account_label(account), region), {}).get('found')
+
+    def due(self, account, region, now, empty_window, recheck):
+        seen = self.seen.get('%s:%s' % (account_label(account), region))
+        return seen is None or now - seen['found'] < empty_window or now - seen['checked'] >= recheck
+
+    def record(self, account, region, found, now):
+        seen = self.seen.setdefault('%s:%s' % (account_label(account), region), {'found': now})
+        seen['checked'] = now
+        if found:
+            seen['found'] = now
+
+region_registry = RegionRegistry()
+
+# Fields of each reservation kept in the history snapshots, in the order they are written. Snapshots are read by the
+# field names in their header line, so fields can be added without making older snapshots unreadable.
+snapshot_fields = ['Account', 'Region', 'ReservedInstancesId', 'AvailabilityZone', 'Scope', 'InstanceType',
+                   'ProductDescription', 'InstanceTenancy', 'InstanceCount', 'State', 'End']
+snapshot_version = 1
+
+# The snapshot record of a reservation, with its end as epoch seconds.
+def snapshot_record(ri, account, region):
+    record = dict((field, ri.get(field)) for field in snapshot_fields)
+    record.update(Account=account_label(account), Region=region, AvailabilityZone=ri.get(u'AvailabilityZone', region),
+                  End=calendar.timegm(ri[u'End'].utctimetuple()))
+    return record
+
+# A snapshot value as shown in the report, ends as dates rather than epoch seconds.
+def snapshot_value(field, value):
+    return time.strftime('%Y-%m-%d', time.gmtime(value)) if field == 'End' and value is not None else value
+
+# Lines of a gzip stream, decompressed a chunk at a time so a snapshot is never held in memory whole.
+def gzip_lines(stream, chunk_size=65536):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + decompressor.decompress(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    for line in (pending + decompressor.flush()).split('\n'):
+        if line:
+            yield line
+
+# Snapshots of the reservations, one per day the report runs, kept as gzip JSON lines in S3 or a local directory
+# and named by date (history_prefix + YYYY-MM-DD.jsonl.gz). The first line is a header with the version, date,
+# time and fields, each following line a reservation's values in the order of those fields. read() streams the
+# records of a snapshot, so comparing with or totalling a snapshot only holds the record being looked at.
+class SnapshotStore(object):
+    suffix = '.jsonl.gz'
+
+    def __init__(self, bucket=None, prefix='', directory=None, region=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.directory = directory
+        self.region = region
+
+    def dates(self):
+        if self.directory is not None:
+            names = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+        else:
+            paginator = get_client('s3', self.region).get_paginator('list_objects_v2')
+            names = [item[u'Key'][len(self.prefix):] for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix)
+                     for item in page.get(u'Contents', [])]
+        return sorted(name[:-len(self.suffix)] for name in names if name.endswith(self.suffix))
+
+    def read(self, date):
+        if self.directory is not None:
+            stream = open(os.path.join(self.directory, date + self.suffix), 'rb')
+        else:
+            stream = get_client('s3', self.region).get_object(Bucket=self.bucket, Key=self.prefix + date + self.suffix)[u'Body']
+        try:
+            lines = gzip_lines(stream)
+            header = json.loads(next(lines))
+            for line in lines:
+                record = dict(zip(header['fields'], json.loads(line)))
+                record['_time'] = header['time']
+                yield record
+        finally:
+            stream.close()
+
+    def write(self, date, now, records):
+        buffer = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as stream:
+            stream.write(json.dumps({'version': snapshot_version, 'date': date, 'time': now, 'fields': snapshot_fields}) + '\n')
+            for record in records:
+                stream.write(json.dumps([record.get(field) for field in snapshot_fields], separators=(',', ':')) + '\n')
+        if self.directory is not None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(os.path.join(self.directory, date + self.suffix), 'wb') as snapshot:
+                snapshot.write(buffer.getvalue())
+        else:
+            get_client('s3', self.region).put_object(Bucket=self.bucket, Key=self.prefix + date + self.suffix,
+                                                     Body=buffer.getvalue(), ContentType='application/gzip')
+
+    # Small JSON documents kept alongside the snapshots, such as the RegionRegistry's records. None if there is none.
+    def read_json(self, name):
+        try:
+            if self.directory is not None:
+                with open(os.path.join(self.directory, name)) as document:
+                    return json.load(document)
+            return json.loads(get_client('s3', self.region).get_object(Bucket=self.bucket, Key=self.prefix + name)[u'Body'].read())
+        except (IOError, botocore.exceptions.ClientError):
+            return None
+
+    def write_json(self, name, data):
+        if self.directory is not None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(os.path.join(self.directory, name), 'w') as document:
+                json.dump(data, document, sort_keys=True)
+        else:
+            get_client('s3', self.region).put_object(Bucket=self.bucket, Key=self.prefix + name, Body=json.dumps(data, sort_keys=True),
+                                                     ContentType='application/json')
+
+# Compare this run's reservations, {(account, id): record}, with the records of the previous snapshot as they are
+# streamed. A reservation is new if it was not in the snapshot, expired if it was active then and is not now (or is
+# gone), expiring if it has come within warning_days of its end since, and modified if its count, state or end
+# changed otherwise. Reservations of regions that failed this run are not compared, and their previous records are
+# returned to be carried into this run's snapshot so the next comparison does not see them as new.
+def diff_snapshot(previous, current, failed, now, warning_days):
+    changes = []
+    carried = []
+    seen = set()
+    warning = warning_days * 86400
+    for old in previous:
+        key = (old['Account'], old['ReservedInstancesId'])
+        seen.add(key)
+        new = current.get(key)
+        was_active = old['State'] == 'active' and old['End'] > old['_time']
+        if new is None:
+            if (old['Account'], old['Region']) in failed:
+                carried.append(old)
+            elif was_active:
+                changes.append(('expired', old, 'no longer listed'))
+            continue
+        if was_active and (new['State'] != 'active' or new['End'] <= now):
+            changes.append(('expired', new, 'now %s' % new['State']))
+        elif new['State'] == 'active' and old['End'] - old['_time'] >= warning > new['End'] - now:
+            changes.append(('expiring', new, 'in %s days' % ((new['End'] - now) / 86400)))
+        else:
+            modified = ['%s %s -> %s' % (field, snapshot_value(field, old.get(field)), snapshot_value(field, new[field]))
+                        for field in ('InstanceCount', 'State', 'End') if old.get(field) != new[field]]
+            if modified:
+                changes.append(('modified', new, ', '.join(modified)))
+    for key in sorted(set(current) - seen):
+        changes.append(('new', current[key], ''))
+    return changes, carried
+
+# The active reservations and the instances they reserve in each snapshot, oldest first, each snapshot streamed in turn.
+def snapshot_trend(store, dates):
+    for date in dates:
+        reservations = instances = 0
+        for record in store.read(date):
+            if record['State'] == 'active' and record['End'] > record['_time']:
+                reservations += 1
+                instances += record['InstanceCount']
+        yield date, reservations, instances
+
+# The rows of one table of the report, kept once as their cells and rendered on demand into text, HTML or CSV by
+# generators over the same rows, so no format is held in memory beyond the output it is written into.
+class ReportTable(object):
+    def __init__(self, header):
+        self.header = header
+        self.rows = []
+
+    def add_row(self, row):
+        self.rows.append(tuple(row))
+
+    def text(self):
+        yield "\t".join([str(cell) for cell in self.header])
+        for row in self.rows:
+            yield "\t".join([str(cell) for cell in row])
+
+    def html(self):
+        yield "<table><tr><th>%s</th></tr>" % ("</th><th>".join(self.header))
+        for row in self.rows:
+            yield html_table_row(row)
+        yield "</table>"
+
+    def csv(self, stream):
+        writer = csv.writer(stream)
+        writer.writerow(self.header)
+        for row in self.rows:
+            writer.writerow([unicode(cell).encode('utf-8') for cell in row])
+
+    def gzip_csv(self):
+        buffer = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as stream:
+            self.csv(stream)
+        return buffer.getvalue()
+
+# Collects the report as region results arrive: the reservations and coverage as ReportTables and the warnings as
+# rendered paragraphs per section, as those sections appear above the tables in the HTML version. When reporting on
+# several accounts each row and warning also names the account. With a history the changes since the previous
+# snapshot and the trend over recent ones are tables too. The full report renders every table, the summary used when
+# it is too large to email leaves out all but the trend in favour of a note saying where they can be found.
+class ReportBuilder(object):
+    def __init__(self, report_title, header, tags_of_interest, red_warning_days, orange_warning_days, multi_account=False):
+        self.multi_account = multi_account
+        if multi_account:
+            header = ['Account'] + header
+        self.report_title = report_title
+        self.header = header
+        self.tags_of_interest = tags_of_interest
+        self.red_warning_days = red_warning_days
+        self.orange_warning_days = orange_warning_days
+        self.now = datetime.datetime.now(tz.tzlocal())
+        self.reservations = ReportTable(header)
+        self.red_warnings = []
+        self.orange_warnings = []
+        self.expired_warnings = []
+        self.errors = []
+        self.skipped = []
+        coverage_header = ['Region', 'Type', 'Platform', 'Tenancy', 'Running', 'Covered', 'Reserved', 'Coverage']
+        self.coverage = ReportTable(['Account'] + coverage_header if multi_account else coverage_header)
+        self.unused_warnings = []
+        self.uncovered_warnings = []
+        changes_header = ['Change', 'id', 'AZ', 'Type', 'Count', 'Detail']
+        self.changes = ReportTable(['Account'] + changes_header if multi_account else changes_header)
+        self.changes_summary = None
+        self.trend = ReportTable(['Date', 'Active reservations', 'Reserved instances'])
+        self.running = 0
+        self.covered = 0
+        self.unused = 0
+
+    #Whether a reservation is in the report: active, or ended within the last 10 days
+    def reportable(self, ri):
+        return ri[u'State'] == 'active' or ri[u'End'] - self.now >= datetime.timedelta(days=-10)
+
+    def add_reservation(self, ri, region, account=None):
+        #Regional reservations have no availability zone, they are shown by their region
+        scope = ri.get(u'AvailabilityZone', region)
+        time_left = ri[u'End'] - self.now
+        where = "%s, %s" % (account_label(account), scope) if self.multi_account else scope
+
+        if not self.reportable(ri):
+            return
+        elif time_left < datetime.timedelta(days=0):
+            self.expired_warnings.append("<p>%s (%s) expired %s days ago</p>" % (ri[u'ReservedInstancesId'], where, abs(time_left.days)))
+        elif time_left < datetime.timedelta(days=self.red_warning_days):
+            self.red_warnings.append("<p>%s (%s) expires in %s days.</p>" % (ri[u'ReservedInstancesId'], where, time_left.days))
+        elif time_left < datetime.timedelta(days=self.orange_warning_days):
+            self.orange_warnings.append("<p>%s (%s) expires in %s days.</p>" % (ri[u'ReservedInstancesId'], where, time_left.days))
+
+        #convert tags to dictionary
+        tags = {}
+        for tag in ri.get('Tags',{}):
+            tags[tag['Key']] = tag['Value']
+
+        #Add the report row
+        row = [ ri[u'ReservedInstancesId'],
+                scope,
+                ri[u'InstanceType'],
+                ri[u'InstanceCount'],
+                ri[u'Duration']/31536000 ,
+                time_left,
+                ]
+        for tag in self.tags_of_interest:
+            row.append(tags.get(tag,'-'))
+        if self.multi_account:
+            row.insert(0, account_label(account))
+        self.reservations.add_row(row)
+
+    def add_coverage(self, region, reservations, running, account=None):
+        coverage, unused = match_reservations(reservations, running, self.now)
+        where = "%s, %s" % (account_label(account), region) if self.multi_account else region
+        for key in sorted(coverage):
+            instance_type, platform, tenancy = key
+            count, covered, reserved = coverage[key]
+            self.running += count
+            self.covered += covered
+            row = [region, instance_type, platform, tenancy, count, covered, reserved,
+                   "%d%%" % (100 * covered / count) if count else '-']
+            if self.multi_account:
+                row.insert(0, account_label(account))
+            self.coverage.add_row(row)
+            if covered < count:
+                self.uncovered_warnings.append("<p>%s: %s of %s running %s %s (%s tenancy) not covered.</p>" % (where, count - covered, count, instance_type, platform, tenancy))
+        for ri, count in sorted(unused, key=lambda unused: unused[0][u'ReservedInstancesId']):
+            scope = ri.get(u'AvailabilityZone', region)
+            if self.multi_account:
+                scope = "%s, %s" % (account_label(account), scope)
+            self.unused += count
+            self.unused_warnings.append("<p>%s (%s) has %s of %s reserved %s unused.</p>" % (ri[u'ReservedInstancesId'], scope, count, ri[u'InstanceCount'], ri[u'InstanceType']))
+
+    def add_changes(self, date, changes):
+        order = ['expired', 'expiring', 'modified', 'new']
+        counts = dict((change, 0) for change in order)
+        for change, record, detail in sorted(changes, key=lambda change: (order.index(change[0]), change[1]['Account'], change[1]['ReservedInstancesId'])):
+            counts[change] += 1
+            row = [change, record['ReservedInstancesId'], record['AvailabilityZone'], record['InstanceType'], record['InstanceCount'], detail]
+            if self.multi_account:
+                row.insert(0, record['Account'])
+            self.changes.add_row(row)
+        self.changes_summary = "Since %s: %s new, %s modified, %s expired and %s now expiring within %s days" % (
+            date, counts['new'], counts['modified'], counts['expired'], counts['expiring'], self.red_warning_days)
+
+    def add_trend(self, trend):
+        for row in trend:
+            self.trend.add_row(row)
+
+    def coverage_summary(self):
+        if not self.running:
+            return "No running instances"
+        return "%d%% of %s running instances covered by reservations, %s reserved instances unused" % (100 * self.covered / self.running, self.running, self.unused)
+
+    def add_error(self, region, error, account=None):
+        if self.multi_account:
+            region = "%s %s" % (account_label(account), region)
+        self.errors.append("<p>%s: %s</p>" % (region, error))
+        self.reservations.add_row([region, 'ERROR: %s' % error] + ['-'] * (len(self.header) - 2))
+
+    def add_skipped(self, region, found, account=None):
+        if self.multi_account:
+            region = "%s %s" % (account_label(account), region)
+        self.skipped.append("%s (empty since %s)" % (region, time.strftime('%Y-%m-%d', time.gmtime(found))))
+
+    def skipped_summary(self):
+        return "Not queried this run, having had nothing to report: %s" % ", ".join(self.skipped)
+
+    def render_text(self, note=None):
+        lines = ["%s" % self.report_title]
+        if note is None:
+            lines.extend(self.reservations.text())
+            lines.extend(["", self.coverage_summary()])
+            lines.extend(self.coverage.text())
+            if self.changes_summary is not None:
+                lines.extend(["", self.changes_summary])
+                lines.extend(self.changes.text())
+        else:
+            lines.append(self.coverage_summary())
+            lines.append("%s regions could not be reported, %s reservations expire within %s days, %s within %s days and %s have expired in the last 10 days."
+                         % (len(self.errors), len(self.red_warnings), self.red_warning_days, len(self.orange_warnings), self.orange_warning_days, len(self.expired_warnings)))
+            if self.changes_summary is not None:
+                lines.append(self.changes_summary)
+            lines.extend(["", note])
+        if self.skipped:
+            lines.extend(["", self.skipped_summary()])
+        if self.trend.rows:
+            lines.append("")
+            lines.extend(self.trend.text())
+        return "\n".join(lines)
+
+    def render_html(self, note=None):
+        html = ['<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional = //EN"><html> <head><style type="text/css"> H2 { color:#FF0000; } H3 { color:#FFA500; } </style></head><body><h1>Global Reserved Instance Report</h1>']
+        if note is not None:
+            html.append("<p>%s</p>" % note)
+        if len(self.errors):
+            html.append("<h2>The following regions could not be reported!</h2>")
+            html.extend(self.errors)
+        if len(self.red_warnings):
+            html.append("<h2>Warning the following will expire within %s days!</h2>" % self.red_warning_days)
+            html.extend(self.red_warnings)
+        if len(self.orange_warnings):
+            html.append("<h3>Warning the following will expire within %s days!</h3>" % self.orange_warning_days)
+            html.extend(self.orange_warnings)
+        if len(self.expired_warnings):
+            html.append("<h3>The following have expired in the last 10 days.</h3>")
+            html.extend(self.expired_warnings)
+        html.append("<h4>%s</h4>" % self.coverage_summary())
+        if self.skipped:
+            html.append("<p>%s</p>" % self.skipped_summary())
+        if len(self.unused_warnings):
+            html.append("<h3>The following reservations are not fully used.</h3>")
+            html.extend(self.unused_warnings)
+        if len(self.uncovered_warnings):
+            html.append("<h3>The following running instances are not covered by a reservation.</h3>")
+            html.extend(self.uncovered_warnings)
+        if self.changes_summary is not None:
+            html.append("<h4>%s</h4>" % self.changes_summary)
+            if note is None:
+                html.extend(self.changes.html())
+        if self.trend.rows:
+            html.append("<h4>Trend</h4>")
+            html.extend(self.trend.html())
+        if note is None:
+            html.append("<h4>All Reservations</h4>")
+            html.extend(self.reservations.html())
+            html.append("<h4>Coverage</h4>")
+            html.extend(self.coverage.html())
+        html.append("</body></html>")
+        return "".join(html)
+
 def lambda_handler(event, context):
     
     #Customisations for report Scope
-    regions = ['us-east-1', 'us-west-2', 'us-west-1', 
-               'eu-west-1', 'eu-central-1', 'ap-southeast-1', 
-               'ap-southeast-2', 'ap-northeast-1', 'sa-east-1']
+    regions = None
+    region_cache_ttl = 86400
+    empty_region_days = 35
+    empty_region_recheck_days = 28
+    account_roles = []
+    max_threads = 16
     tags_of_interest = ['product', 'app', 'env', 'role']
     red_warning_days = 30
     orange_warning_days = 180
+    region_timeout = 20
     
     #Configuration for report sending
     report_title = "Reserved Instance Expiry"
@@ -71,89 +769,176 @@ def lambda_handler(event, context):
     from_address = 'lambda_reporting@example.com'
     to_address = 'devops@example.com'
     ses_region = 'eu-west-1'
+    max_email_bytes = 5000000
+    report_bucket = None
+    report_prefix = 'reserved_instance_report/'
+    attach_large_report = True
+
+    #Configuration for history, kept in S3 (history_bucket) or a local directory (history_dir)
+    history_bucket = None
+    history_prefix = 'reserved_instance_report/history/'
+    history_dir = None
+    history_weeks = 12
     
+    client_stats.update(created=0, reused=0)
+    metrics.reset()
+
+    #Leave time to build and send the report before Lambda's own timeout.
+    if context is not None:
+        region_timeout = max(min(region_timeout, context.get_remaining_time_in_millis() / 1000.0 - 10), 0)
+
     #Headers for full report table
-    report_list = [['id', 'AZ', 'Type', 'Count', 'Length (years)', 'Time Left',]+tags_of_interest ]
-    expired_warning_reservations = []
-    red_warning_reservations = []
-    orange_warning_reservations = []
-            
-    for region in regions:
-        print "Processing %s" % region
-        ec2 = boto3.client('ec2', region_name=region)
-        response = ec2.describe_reserved_instances()
-        for ri in response['ReservedInstances']:
-            time_left = ri[u'End'] - datetime.datetime.now(tzlocal())
-            
-            if time_left < datetime.timedelta(days=-10):
-                pass
-            elif time_left < datetime.timedelta(days=0):
-                expired_warning_reservations.append([ri[u'ReservedInstancesId'], ri[u'AvailabilityZone'],  time_left])
-            elif time_left < datetime.timedelta(days=red_warning_days):
-                red_warning_reservations.append([ri[u'ReservedInstancesId'], ri[u'AvailabilityZone'],  time_left])
-            elif time_left < datetime.timedelta(days=orange_warning_days):
-                orange_warning_reservations.append([ri[u'ReservedInstancesId'], ri[u'AvailabilityZone'], time_left])
-            
-            #convert tags to dictionary
-            tags = {}
-            for tag in ri.get('Tags',{}):
-                tags[tag['Key']] = tag['Value']
-            
-            #Add the report row to the list
-            row = [ ri[u'ReservedInstancesId'], 
-                    ri[u'AvailabilityZone'], 
-                    ri[u'InstanceType'], 
-                    ri[u'InstanceCount'],
-                    ri[u'Duration']/31536000 , 
-                    time_left,
-                    ]
-            
-            for tag in tags_of_interest:
-                row.append(tags.get(tag,'-'))
-            
-            if time_left > datetime.timedelta(days=-10):
-                report_list.append( row )
-     
-    #Created text version
-    msg = "%s\n" % report_title
-    msg += "\n".join(["\t".join([str(cell) for cell in row]) for row in report_list])
-    
-    #Create HTML Version
-    html_msg = '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional = //EN"><html> <head><style type="text/css"> H2 { color:#FF0000; } H3 { color:#FFA500; } </style></head><body><h1>Global Reserved Instance Report</h1>'
+    header = ['id', 'AZ', 'Type', 'Count', 'Length (years)', 'Time Left',]+tags_of_interest
+    report = ReportBuilder(report_title, header, tags_of_interest, red_warning_days, orange_warning_days, multi_account=bool(account_roles))
 
-    
-    if len(red_warning_reservations):
-        html_msg+="<h2>Warning the following will expire within %s days!</h2>" % red_warning_days
-        for row in red_warning_reservations:
-            html_msg += "<p>%s (%s) expires in %s days.</p>" % (row[0], row[1], row[2].days)
-    if len(orange_warning_reservations):
-        html_msg+="<h3>Warning the following will expire within %s days!</h3>" % orange_warning_days
-        for row in orange_warning_reservations:
-            html_msg += "<p>%s (%s) expires in %s days.</p>" % (row[0], row[1], row[2].days)
-    if len(expired_warning_reservations):
-        html_msg+="<h3>The following have expired in the last 10 days.</h3>"
-        for row in expired_warning_reservations:
-            html_msg += "<p>%s (%s) expired %s days ago</p>" % (row[0], row[1], abs(row[2].days))    
-            
-    html_msg += "<h4>All Reservations</h4>"
-    html_msg += list_to_html_table(report_list)
-    html_msg += '</body></html>'
-    
-    ses = boto3.client('ses', region_name=ses_region)
-    ses.send_email( Source= from_address,
-                    Destination={
-                        'ToAddresses': [ to_address, ],
-                        'CcAddresses': [],
-                        'BccAddresses': []
-                    },
-                    Message={
-                        'Subject': {'Data': subject_string },
-                        'Body': {
-                            'Text': {'Data': msg,},
-                            'Html': {'Data': html_msg,}
-                        }
-                    },
-                    ReplyToAddresses=[ from_address, ]
-                )
+    store = None
+    if history_bucket or history_dir:
+        store = SnapshotStore(history_bucket, history_prefix, history_dir, ses_region)
+        try:
+            region_registry.seen.update(store.read_json('regions.json') or {})
+        except Exception as e:
+            print "Region records unavailable: %s" % e
+    snapshot = {}
+    failed = set()
+
+    #Find the regions of every account, leaving out those which have long been empty. They are treated as failed when
+    #comparing with the last snapshot, so anything they did have is carried over rather than reported as gone.
+    started = now = time.time()
+    accounts = [None] + account_roles
+    due = []
+    for account in accounts:
+        try:
+            account_regions = regions or region_registry.regions(account, region_cache_ttl)
+        except Exception as e:
+            print "Failed %s region discovery: %s" % (account_label(account), e)
+            report.add_error('regions', e, account)
+            continue
+        for region in account_regions:
+            if region_registry.due(account, region, now, empty_region_days * 86400, empty_region_recheck_days * 86400):
+                due.append((account, region))
+            else:
+                report.add_skipped(region, region_registry.last_found(account, region), account)
+                failed.add((account_label(account), region))
+
+    #Query the regions of every account in parallel, adding each region's rows to the report as it responds.
+    tasks = Queue.Queue()
+    for account, region in sorted(due, key=lambda task: -(region_registry.last_found(*task) or now)):
+        tasks.put((account, region))
+    results = Queue.Queue()
+    for _ in range(min(max_threads, tasks.qsize())):
+        thread = threading.Thread(target=fetch_regions, args=(tasks, results))
+        thread.daemon = True
+        thread.start()
+
+    deadline = time.time() + region_timeout
+    pending = set(due)
+    while pending:
+        try:
+            (account, region), reservations, running, error = results.get(timeout=max(deadline - time.time(), 0))
+        except Queue.Empty:
+            break
+        pending.discard((account, region))
+        if error is not None:
+            print "Failed %s %s: %s" % (account_label(account), region, error)
+            report.add_error(region, error, account)
+            failed.add((account_label(account), region))
+            continue
+        print "Processing %s %s" % (account_label(account), region)
+        #Reservations which ended long ago are still described, they do not make a region any less empty.
+        region_registry.record(account, region, bool(running) or any(report.reportable(ri) for ri in reservations), now)
+        #A region whose reservations cannot be reported is reported as failed, rather than failing the whole report.
+        try:
+            for ri in reservations:
+                report.add_reservation(ri, region, account)
+                if store is not None:
+                    snapshot[(account_label(account), ri[u'ReservedInstancesId'])] = snapshot_record(ri, account, region)
+            with metrics.phase('match'):
+                report.add_coverage(region, reservations, running, account)
+        except Exception as e:
+            print "Failed %s %s: %s" % (account_label(account), region, e)
+            report.add_error(region, e, account)
+            failed.add((account_label(account), region))
+
+    for account, region in sorted(pending):
+        print "Timed out %s %s" % (account_label(account), region)
+        report.add_error(region, 'no response within %s seconds' % region_timeout, account)
+        failed.add((account_label(account), region))
+
+    metrics.add_phase('fetch', time.time() - started)
+
+    #Compare with the previous snapshot and save this run's, carrying over the reservations of failed regions.
+    if store is not None:
+        with metrics.phase('history'):
+            try:
+                today = report.now.strftime('%Y-%m-%d')
+                now = int(time.time())
+                dates = [date for date in store.dates() if date < today]
+                carried = []
+                if dates:
+                    changes, carried = diff_snapshot(store.read(dates[-1]), snapshot, failed, now, red_warning_days)
+                    report.add_changes(dates[-1], changes)
+                store.write(today, now, snapshot.values() + carried)
+                report.add_trend(snapshot_trend(store, (dates + [today])[-history_weeks:]))
+            except Exception as e:
+                print "History unavailable: %s" % e
+            try:
+                store.write_json('regions.json', region_registry.seen)
+            except Exception as e:
+                print "Region records not saved: %s" % e
+
+    with metrics.phase('render'):
+        msg = report.render_text()
+        html_msg = report.render_html()
+        report_bytes = len(msg) + len(html_msg)
+        attachments = []
+        if report_bytes > max_email_bytes:
+            attachments = [('reservations.csv.gz', report.reservations.gzip_csv()), ('coverage.csv.gz', report.coverage.gzip_csv())]
+            if report.changes_summary is not None:
+                attachments.append(('changes.csv.gz', report.changes.gzip_csv()))
+
+    with metrics.phase('send'):
+        #Too large to email, so send a summary with the full report as gzipped CSV in S3 and/or attached. Attachments
+        #are base64 encoded, growing them by a third, and are left out if even that would not fit.
+        attach = attach_large_report and sum(len(data) for _, data in attachments) * 4 / 3 < max_email_bytes
+        if attachments:
+            delivered = []
+            if report_bucket:
+                s3 = get_client('s3', ses_region)
+                for filename, data in attachments:
+                    key = '%s%s/%s' % (report_prefix, report.now.strftime('%Y-%m-%d'), filename)
+                    s3.put_object(Bucket=report_bucket, Key=key, Body=data, ContentType='application/gzip')
+                    delivered.append('s3://%s/%s' % (report_bucket, key))
+            delivered = ["uploaded to %s" % ", ".join(delivered)] if delivered else []
+            if attach:
+                delivered.append("attached to this email")
+            note = "The full report is %s bytes, too large to email. Its tables as gzipped CSV are %s." % (report_bytes, " and ".join(delivered) or "not delivered, set report_bucket to upload them to S3")
+            print note
+            msg = report.render_text(note)
+            html_msg = report.render_html(note)
+
+        ses = get_client('ses', ses_region)
+        if attachments and attach:
+            ses.send_raw_email(Source=from_address, Destinations=[ to_address, ],
+                               RawMessage={'Data': raw_email(from_address, to_address, subject_string, msg, html_msg, attachments)})
+        else:
+            ses.send_email( Source= from_address,
+                            Destination={
+                                'ToAddresses': [ to_address, ],
+                                'CcAddresses': [],
+                                'BccAddresses': []
+                            },
+                            Message={
+                                'Subject': {'Data': subject_string },
+                                'Body': {
+                                    'Text': {'Data': msg,},
+                                    'Html': {'Data': html_msg,}
+                                }
+                            },
+                            ReplyToAddresses=[ from_address, ]
+                        )
+    print "Clients created: %s, client constructions saved by reuse: %s" % (client_stats['created'], client_stats['reused'])
+    metrics.emit(RegionsFailed=len(report.errors), RegionsSkipped=len(report.skipped), InstancesRunning=report.running, InstancesCovered=report.covered,
+                 ReservationsUnused=report.unused, ReportBytes=report_bytes, ReportSummarised=int(bool(attachments)),
+                 ClientsCreated=client_stats['created'], ClientsReused=client_stats['reused'])
 
     return True
\ No newline at end of file
@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import imp, json, logging, os, StringIO, sys, threading, time, unittest
+import botocore.exceptions
+
+# test_photographer.py
+#
+#    Runs photographer.py's lambda_handler against the in-memory account of the benchmark, checking what it leaves
+#    behind in the account and in its state file:
+#       python tests/test_photographer.py
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root_dir, 'benchmarks'))
+import benchmark
+
+# Seconds a handler is given before it is taken to be stuck.
+handler_timeout = 20
+
+
+
+# FailingClient
+#
+# A benchmark FakeClient whose operations named in failures raise the exception given for them.
+class FailingClient(benchmark.FakeClient):
+    def __init__(self, backend, service, region, failures):
+        benchmark.FakeClient.__init__(self, backend, service, region)
+        self.failures = failures
+
+    def __getattribute__(self, name):
+        failures = object.__getattribute__(self, 'failures')
+        if name in failures:
+            def fail(**kwargs):
+                object.__getattribute__(self, 'call')(name)
+                raise failures[name]
+            return fail
+        return object.__getattribute__(self, name)
+
+
+
+# Context
+#
+# Stand-in for the Lambda context, with the given seconds remaining when the handler is invoked.
+class Context(object):
+    def __init__(self, seconds):
+        self.deadline = time.time() + seconds
+
+    def get_remaining_time_in_millis(self):
+        return int(max(self.deadline - time.time(), 0) * 1000)
+
+
+
+# Account
+#
+# A synthetic account, as in the photographer-small benchmark scenario, and a freshly loaded photographer.py working
+# against it. Operations named in failures raise the exception given for them.
+class Account(object):
+    def __init__(self, failures=None, **scenario):
+        self.scenario = dict({'script': 'photographer', 'policies': 1, 'volumes': 4, 'instances': 2, 'history': 30,
+                              'regions': ['eu-west-1'], 'latency': 0}, **scenario)
+        self.backend = benchmark.FakeBackend(self.scenario)
+        self.failures = failures or {}
+        self.backend.get_client = lambda service, aws_region=None, *args, **kwargs: FailingClient(self.backend, service, aws_region, self.failures)
+        self.photographer = imp.load_source('photographer', os.path.join(root_dir, 'scripts', 'photographer.py'))
+        self.photographer.get_client = self.backend.get_client
+        self.photographer.deletion_rate = self.photographer.deletion_burst = 1000
+        self.photographer.copy_rate = self.photographer.copy_burst = 1000
+        self.config = benchmark.build_photographer_account(self.backend, self.scenario)
+        self.backend.objects[self.photographer.s3_file] = self.config
+
+    # Invoke the handler in a thread, returning its summary, or None if it has not returned within handler_timeout.
+    # Given seconds, the handler has that long as a Lambda would. The metrics line it prints is discarded.
+    def run(self, event=None, seconds=None):
+        result = []
+        context = Context(seconds) if seconds is not None else None
+        thread = threading.Thread(target=lambda: result.append(self.photographer.lambda_handler(event or {}, context)))
+        thread.daemon = True
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            thread.start()
+            thread.join(handler_timeout)
+        finally:
+            sys.stdout = stdout
+        return result[0] if result else None
+
+    def state(self):
+        return json.loads(self.backend.objects[self.photographer.s3_state_file])
+
+    def resources(self, region, kind):
+        return self.backend.region(region)[kind]
+
+
+
+class DeletionTest(unittest.TestCase):
+
+    def test_connection_errors_do_not_stop_the_run(self):
+        error = botocore.exceptions.EndpointConnectionError(endpoint_url='https://ec2.eu-west-1.amazonaws.com')
+        account = Account(failures={'delete_snapshot': error, 'deregister_image': error})
+        summary = account.run()
+        self.assertIsNotNone(summary, 'lambda_handler did not return')
+        self.assertEqual(summary['deletions']['deleted'], 0)
+        self.assertTrue(summary['deletions']['failed'] > 0)
+        self.assertIn('assets', account.state())
+
+    def test_copy_errors_do_not_stop_the_run(self):
+        error = botocore.exceptions.ReadTimeoutError(endpoint_url='https://ec2.us-west-2.amazonaws.com')
+        account = Account(failures={'copy_snapshot': error, 'copy_image': error}, enabled_regions=['eu-west-1', 'us-west-2'])
+        account.photographer.dr_region = 'us-west-2'
+        summary = account.run()
+        self.assertIsNotNone(summary, 'lambda_handler did not return')
+        self.assertEqual(summary['copies']['copied'], 0)
+        self.assertTrue(summary['copies']['failed'] > 0)
+        self.assertEqual(sum(account.photographer.replication_stage.in_progress.values()), 0)
+        self.assertIn('assets', account.state())
+
+
+    def test_deferred_deletions_respect_retention_tags(self):
+        account = Account()
+        account.photographer.deletion_time_budget = 0
+        summary = account.run()
+        self.assertTrue(summary['deletions']['deferred'] > 0)
+        self.assertEqual(account.state()['pending_deletions'], [])
+        self.assertTrue(account.state()['retention_cursor'])
+
+        # A deferred snapshot tagged since is kept, the other deferred deletions go ahead on the next run.
+        deferred = [intent['id'] for intent in account.photographer.deletion_stage.deferred if intent['kind'] == 'snapshot']
+        account.backend.tag('eu-west-1', deferred[:1], [{u'Key': u'retention', u'Value': u'keep'}])
+        account.photographer.deletion_time_budget = 120
+        account.run()
+        snapshots = account.resources('eu-west-1', 'snapshots')
+        self.assertIn(deferred[0], snapshots)
+        self.assertEqual([snapshot_id for snapshot_id in deferred[1:] if snapshot_id in snapshots], [])
+
+
+
+class BackupTagTest(unittest.TestCase):
+
+    def test_reserved_and_surplus_tags_are_dropped(self):
+        account = Account(volumes=1, instances=1)
+        tags = [{u'Key': u'aws:cloudformation:stack-name', u'Value': u'stack'}] + [{u'Key': u'tag-%02d' % n, u'Value': u'x'} for n in range(60)]
+        for kind in ('volumes', 'instances'):
+            for resource in account.resources('eu-west-1', kind).values():
+                resource[u'Tags'] = resource[u'Tags'] + tags
+        summary = account.run()
+        self.assertEqual([job for job in summary['failed'] if job.startswith('backup_')], [])
+
+        state = account.state()
+        backups = [backup_id for asset in state['assets'].values() for backup_id in asset.get('pending', {})]
+        self.assertEqual(len(backups), 2)
+        for kind in ('snapshots', 'images'):
+            for backup_id in backups:
+                backup = account.resources('eu-west-1', kind).get(backup_id)
+                if backup is not None:
+                    self.assertEqual(len(backup[u'Tags']), 50)
+                    self.assertFalse([tag for tag in backup[u'Tags'] if tag[u'Key'].startswith('aws:')])
+
+
+
+class ReplicationTest(unittest.TestCase):
+
+    # The completed copies of each asset in a region, by the source backup ids they copy, and the ids copies exist for.
+    def copies(self, account, region):
+        state = account.state()
+        copies = dict((key, set(replica['source'] for replica in asset.get('replicas', {}).values()
+                                if replica['region'] == region and replica['state'] == 'completed'))
+                      for key, asset in state['assets'].items())
+        existing = set(account.resources(region, 'snapshots')) | set(account.resources(region, 'images'))
+        for asset in state['assets'].values():
+            for replica in asset.get('replicas', {}).values():
+                if replica['region'] == region and replica['state'] == 'completed':
+                    self.assertIn(replica['id'], existing)
+        return copies
+
+    def kept(self, account):
+        return dict((key, set(asset['kept'])) for key, asset in account.state()['assets'].items())
+
+    def test_copy_confirm_retain_and_move(self):
+        account = Account(enabled_regions=['eu-west-1', 'us-west-2', 'us-east-1'])
+        account.photographer.copy_limits = {'snapshot': 1000, 'image': 1000}
+        config = account.config.replace('months: 6\n', 'months: 6\ndr_region: us-west-2\n')
+        account.backend.objects[account.photographer.s3_file] = config
+
+        # The first run starts a copy of every kept backup, the second confirms them.
+        account.run()
+        pending = [replica for asset in account.state()['assets'].values() for replica in asset['replicas'].values()]
+        self.assertEqual(set(replica['state'] for replica in pending), set(['pending']))
+        self.assertEqual(len(pending), sum(len(kept) for kept in self.kept(account).values()))
+        account.run()
+        self.assertEqual(self.copies(account, 'us-west-2'), self.kept(account))
+
+        # Tighter limits delete the backups and the copies they no longer keep, on both sides.
+        copies = len(account.resources('us-west-2', 'snapshots'))
+        config = config.replace('days: 7', 'days: 2').replace('weeks: 4', 'weeks: 1')
+        account.backend.objects[account.photographer.s3_file] = config
+        account.run()
+        self.assertEqual(self.copies(account, 'us-west-2'), self.kept(account))
+        self.assertTrue(len(account.resources('us-west-2', 'snapshots')) < copies)
+
+        # Moved to another region, the backups are copied there, after which the copies left behind are deleted.
+        account.backend.objects[account.photographer.s3_file] = config.replace('us-west-2', 'us-east-1')
+        account.run()
+        self.assertEqual(self.copies(account, 'us-west-2'), self.kept(account))
+        account.run()
+        self.assertEqual(self.copies(account, 'us-east-1'), self.kept(account))
+        account.run()
+        self.assertEqual(account.resources('us-west-2', 'snapshots'), {})
+        self.assertEqual(account.resources('us-west-2', 'images'), {})
+        self.assertEqual(self.copies(account, 'us-east-1'), self.kept(account))
+
+
+
+class StateTest(unittest.TestCase):
+
+    def test_assets_no_longer_selected_are_forgotten(self):
+        account = Account(volumes=2, instances=0)
+        account.run()
+        volume_ids = sorted(account.resources('eu-west-1', 'volumes'))
+        self.assertEqual(sorted(account.state()['assets']), ['eu-west-1:%s' % volume_id for volume_id in volume_ids])
+
+        # Once the policy drops a volume its state stays for state_prune_days, then goes.
+        account.backend.objects[account.photographer.s3_file] = account.config.replace(' %s' % volume_ids[1], '')
+        time.sleep(1.1)
+        account.run()
+        self.assertEqual(len(account.state()['assets']), 2)
+        account.photographer.state_prune_days = 0
+        account.run()
+        self.assertEqual(sorted(account.state()['assets']), ['eu-west-1:%s' % volume_ids[0]])
+
+
+
+class TimeBudgetTest(unittest.TestCase):
+
+    def test_backups_and_retention_share_the_budget(self):
+        account = Account(volumes=60, instances=0, latency=0.01)
+        account.photographer.time_safety_margin = 0
+        account.photographer.operation_limits = {'create_snapshot': 1, 'create_image': 1}
+        created = []
+        for run in range(6):
+            calls = account.backend.calls.get('create_snapshot', 0)
+            summary = account.run(seconds=0.6)
+            created.append(account.backend.calls.get('create_snapshot', 0) - calls)
+            self.assertTrue(created[-1] < 60, 'every volume was backed up, the budget is too long to test with')
+            self.assertTrue([job for job in summary['succeeded'] if job.startswith('process_volume_id')], 'run %s processed nothing' % run)
+
+        # Between them the runs decided retention for every volume, and took backups of the volumes in turn.
+        state = account.state()
+        self.assertEqual(len([key for key, asset in state['assets'].items() if asset.get('decided')]), 60)
+        backups = [len(asset.get('pending', {})) for asset in state['assets'].values()]
+        self.assertEqual(len(backups), 60)
+        self.assertTrue(max(backups) - min(backups) <= 1, backups)
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    unittest.main()
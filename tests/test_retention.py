@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import calendar, os, random, sys, unittest
+import datetime
+from dateutil.tz import tzutc
+
+# test_retention.py
+#
+#    Checks the retention engine of photographer.py against the original quadratic implementation of dates_to_keep,
+#    over randomly generated backup histories and retention limits. Each case is seeded, so a failure names the seed
+#    which reproduces it:
+#       python tests/test_retention.py
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License version 3, as
+#    published by the Free Software Foundation.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+import photographer
+
+cases = 500
+
+
+
+# oracle_dates_to_keep
+#
+# dates_to_keep as it was before the retention engine, scanning every date for every window. Kept as the reference
+# the engine must agree with, only the debugging print is left out.
+def oracle_dates_to_keep(dates = None, retention_limits=None, now_time=None):
+
+    defaults = {'most_recent':{'default':5},
+                'days'  :{'default':7, 'number_of_days':1 },
+                'weeks' :{'default':4, 'number_of_days':7 },
+                'months':{'default':6, 'number_of_days':31}
+                }
+
+    now_time =  datetime.datetime.strptime(now_time.strftime("%Y-%m-%d"), "%Y-%m-%d")
+
+    if retention_limits is None:
+        retention_limits = {}
+    if dates is None:
+        return []
+
+    #check if dates are tz aware:
+    if dates[0].tzinfo is not None:
+        now_time = datetime.datetime(now_time.year, now_time.month, now_time.day, tzinfo=tzutc())
+
+    date_selection = dict([(date, False) for date in dates])
+
+    #mark up the most recent required.
+    dates.sort()
+    for date in dates[-retention_limits.get('most_recent', defaults['most_recent']['default']):]:
+        date_selection[date] = True
+
+    # For each limit (days, weeks, months), step through the limit, finding days in scope and marking
+    # the oldest as to be retained.
+    for limit in ['days','weeks','months']:
+        for day in range(0, retention_limits.get(limit,  defaults[limit]['default']) ):
+            start_time = now_time-datetime.timedelta(days=day*defaults[limit]['number_of_days'])
+            end_time = now_time-datetime.timedelta(days=(day-1)*defaults[limit]['number_of_days'])
+            dates_in_scope = [date for date in date_selection if  start_time <= date < end_time]
+            try:
+                oldest_backup_in_scope = min(dates_in_scope)
+                date_selection[oldest_backup_in_scope] = True
+            except ValueError:
+                pass
+
+    returning_dates = [date for date in date_selection if date_selection[date] is True]
+    return returning_dates
+
+
+
+# random_case
+#
+# A backup history and retention limits drawn from seed. Histories span up to a year before now, with runs of
+# backups taken at the same second, backups on or beside the day boundaries and backups from the future, and each
+# limit is either left to its default or drawn from 0 to 40.
+def random_case(seed):
+    rng = random.Random(seed)
+    now = datetime.datetime(2016, 1, 1, tzinfo=tzutc()) + datetime.timedelta(seconds=rng.randint(0, 5 * 365 * 86400))
+    dates = []
+    midnight = now.replace(hour=0, minute=0, second=0)
+    for _ in range(rng.randint(1, 200)):
+        date = now - datetime.timedelta(seconds=rng.randint(-86400, 365 * 86400))
+        if rng.random() < 0.3:
+            # Exactly on a window boundary, or a second either side of one.
+            date = midnight - datetime.timedelta(days=rng.randint(-1, 365), seconds=rng.choice([-1, 0, 0, 1]))
+        dates.extend([date] * rng.choice([1, 1, 1, 2, 3]))
+    rng.shuffle(dates)
+    limits = dict((limit, rng.randint(0, 40)) for limit in ['most_recent', 'days', 'weeks', 'months'] if rng.random() < 0.8)
+    return dates, limits, now
+
+
+
+class RetentionEquivalenceTest(unittest.TestCase):
+
+    def test_dates_to_keep(self):
+        for seed in range(cases):
+            dates, limits, now = random_case(seed)
+            expected = sorted(oracle_dates_to_keep(list(dates), limits, now))
+            self.assertEqual(photographer.dates_to_keep(dates, limits, now), expected, 'seed %s' % seed)
+
+    def test_naive_dates(self):
+        for seed in range(cases):
+            dates, limits, now = random_case(seed)
+            dates = [date.replace(tzinfo=None) for date in dates]
+            expected = sorted(oracle_dates_to_keep(list(dates), limits, now))
+            self.assertEqual(photographer.dates_to_keep(dates, limits, now), expected, 'seed %s' % seed)
+
+    def test_caller_list_unchanged(self):
+        for seed in range(cases):
+            dates, limits, now = random_case(seed)
+            original = list(dates)
+            photographer.dates_to_keep(dates, limits, now)
+            self.assertEqual(dates, original, 'seed %s' % seed)
+
+    def test_retention_mask(self):
+        for seed in range(cases):
+            dates, limits, now = random_case(seed)
+            kept = set(oracle_dates_to_keep(list(dates), limits, now))
+            created = [calendar.timegm(date.utctimetuple()) for date in dates]
+            mask = photographer.retention_mask(created, limits, calendar.timegm(now.utctimetuple()))
+            self.assertEqual(list(mask), [int(date in kept) for date in dates], 'seed %s' % seed)
+
+    def test_reasons_cover_kept_dates(self):
+        for seed in range(cases):
+            dates, limits, now = random_case(seed)
+            reasons = photographer.retention_reasons(dates, limits, now)
+            self.assertEqual(sorted(reasons), sorted(oracle_dates_to_keep(list(dates), limits, now)), 'seed %s' % seed)
+            self.assertTrue(set(reasons.values()) <= set(photographer.retention_reason_order), 'seed %s' % seed)
+
+    def test_no_dates(self):
+        self.assertEqual(photographer.dates_to_keep(None), [])
+        self.assertEqual(photographer.dates_to_keep([]), [])
+
+
+
+if __name__ == '__main__':
+    unittest.main()